@@ -15,6 +15,7 @@
 #   - [Statistics](#statistics)
 #   - [Visualizations](#visualizations)
 # - [Performing Your Own Analysis](#eda_continued)
+# - [Scaling Up the Analysis](#scaling)
 # - [Conclusions](#conclusions)
 # 
 # <a id='intro'></a>
@@ -64,6 +65,16 @@ from pprint import pprint # use to print data structures like dictionaries in
                           # a nicer way than the base print function.
 
 
+# The functions that do the heavy lifting of the analysis live in the `bikeshare` package next to this notebook, which can also be run without it from the command line, as in `python -m bikeshare report data/NYC-2016-Summary.csv`. The cells below import them where they are first needed.
+#
+# The data files are all opened through `open_data_file`, which decompresses files ending in `.gz`, `.bz2` or `.zst` as they are read, so raw feeds never need to be unpacked to disk first, and compresses the files it writes with such a name. Reading and writing `.zst` files needs the optional `zstandard` package.
+
+# In[ ]:
+
+
+from bikeshare.files import open_data_file
+
+
 # In[6]:
 
 
@@ -76,7 +87,7 @@ def print_first_point(filename):
     city = filename.split('-')[0].split('/')[-1]
     print('\nCity: {}'.format(city))
     
-    with open(filename, 'r') as f_in:
+    with open_data_file(filename, 'r') as f_in:
         ## TODO: Use the csv library to set up a DictReader object. ##
         ## see https://docs.python.org/3/library/csv.html           ##
         trip_reader = csv.DictReader(f_in)
@@ -158,6 +169,14 @@ for city in tests:
     assert abs(duration_in_mins(example_trips[city], city) - tests[city]) < .001
 
 
+# Parsing every start time with `datetime.strptime` is by far the slowest part of condensing a full-year file. Since every day of the year has many trips, and a clock only has so many distinct hours and minutes, the cell below remembers the month and day of the week of every date string, and the hour of every hour string, it has parsed once. Only start times with a part not seen before go through `strptime`.
+
+# In[ ]:
+
+
+from bikeshare.parsing import parse_start_time, parse_start_times
+
+
 # In[8]:
 
 
@@ -176,13 +195,11 @@ def time_of_trip(datum, city):
     # YOUR CODE HERE
     
     if city == 'NYC':
-        d = datetime.strptime(datum['starttime'],'%m/%d/%Y %H:%M:%S')
+        return parse_start_time(datum['starttime'], '%H:%M:%S')
     elif city == 'Chicago':
-        d = datetime.strptime(datum['starttime'],'%m/%d/%Y %H:%M')
+        return parse_start_time(datum['starttime'], '%H:%M')
     else:
-        d = datetime.strptime(datum['Start date'],'%m/%d/%Y %H:%M')
-        
-    return (d.month,d.hour,d.strftime('%A'))
+        return parse_start_time(datum['Start date'], '%H:%M')
     
 
 # Some tests to check that your code works. There should be no output if all of
@@ -194,11 +211,19 @@ tests = {'NYC': (1, 0, 'Friday'),
 
 for city in tests:
     assert time_of_trip(example_trips[city], city) == tests[city]
+    # a second time, now from the remembered dates and clocks
+    assert time_of_trip(example_trips[city], city) == tests[city]
+
+assert parse_start_times(['1/1/2016 00:09:55', '3/31/2016 23:30:00'],
+                         '%H:%M:%S') == ([1, 3], [0, 23], ['Friday', 'Thursday'])
 
 
 # In[9]:
 
 
+from bikeshare.adapters import city_adapters, user_type_mapper
+
+
 def type_of_user(datum, city):
     """
     Takes as input a dictionary containing info about a single trip (datum) and
@@ -211,16 +236,10 @@ def type_of_user(datum, city):
     
     # YOUR CODE HERE
     
-    if city == 'Washington':
-        
-        if datum['Member Type'] == 'Registered':
-            user_type = 'Subscriber'
-        else:
-            user_type = 'Customer'
-           
-        
-    elif city == 'Chicago' or city == 'NYC' :
-        user_type = datum['usertype']
+    # each city's column and names for the user types are those condense_data
+    # uses, so Washington's Registered and Member are both Subscribers
+    adapter = city_adapters[city]
+    user_type = user_type_mapper(adapter)(datum[adapter['user_column']])
         
     return user_type
 
@@ -237,53 +256,50 @@ for city in tests:
     assert type_of_user(example_trips[city], city) == tests[city]
 
 
+# The helper functions above look every value up by column name in a dictionary built for each row, and check the city every time. To condense whole files, each city is instead described once in `city_adapters`: which columns hold the duration, start time and user type, the unit of the duration, the format of the start time and how user types map to Subscriber and Customer. `compile_city_adapter` turns this description and the header of a file into a function from a row of `csv.reader` to the condensed values, taking each value straight from its position. Another bike share system is added with a single `register_city` call, as `bikeshare/adapters.py` does for the Bay Area files of the `/examples/` folder.
+
+# In[ ]:
+
+
+from bikeshare.adapters import compile_city_adapter
+
+
+# the adapters give the same values as the helper functions
+for city, trip in example_trips.items():
+    header = list(trip)
+    transform = compile_city_adapter(city, header)
+    assert transform(list(trip.values())) == (
+        duration_in_mins(trip, city),) + time_of_trip(trip, city) + (
+        type_of_user(trip, city),)
+
+
 # **Question 3b**: Now, use the helper functions you wrote above to create a condensed data file for each city consisting only of the data fields indicated above. In the `/examples/` folder, you will see an example datafile from the [Bay Area Bike Share](http://www.bayareabikeshare.com/open-data) before and after conversion. Make sure that your output is formatted to be consistent with the example file.
 
-# In[10]:
+# Besides the csv file, `condense_data` can also write the condensed data in a compact binary format, which the analysis in the [Scaling Up the Analysis](#scaling) section can map into memory and read without any parsing. A binary summary file holds:
+#
+# - a 24 byte header: the magic string `BIKESUM1`, the number of trips and the byte offset of the trailer, as little-endian unsigned 64-bit integers,
+# - one 8 byte record per trip: the duration in minutes as a `float32`, then the month, hour, day of week code and user type code as one byte each,
+# - a JSON trailer with the `day_names` and `user_type_names` lists the codes index into.
 
+# Questions such as the number of trips by month and user type only group the trips over a few small dimensions, so they can be answered from counts kept per combination of these dimensions rather than from the trips themselves. With `cube_file`, `condense_data` also writes such a cube: for every month, hour, day of week and user type, the number of trips, their total duration and the number of trips longer than 30 minutes. `cube_query` then answers any slice or roll-up of it with array sums.
 
-def condense_data(in_file, out_file, city):
-    """
-    This function takes full data from the specified input file
-    and writes the condensed data to a specified output file. The city
-    argument determines how the input file will be parsed.
-    
-    HINT: See the cell below to see how the arguments are structured!
-    """
-    
-    with open(out_file, 'w') as f_out, open(in_file, 'r') as f_in:
-        # set up csv DictWriter object - writer requires column names for the
-        # first row as the "fieldnames" argument
-        out_colnames = ['duration', 'month', 'hour', 'day_of_week', 'user_type']        
-        trip_writer = csv.DictWriter(f_out, fieldnames = out_colnames)
-        trip_writer.writeheader()
-        
-        ## TODO: set up csv DictReader object ##
-        trip_reader = csv.DictReader(f_in)
+# The same report is run many times against summary files that rarely change. The statistics functions can keep their results in a cache on disk, so a run only computes what the previous runs have not. The cache is off unless `result_cache_dir` names a directory; the command line interface keeps it in `./.result-cache` unless given `--no-cache`. A result is looked up by the function name, its parameters, a hash of the source of the package and a hash of the content of the data file, so a result is never reused once the file or the code changes, and the files written by `condense_data` also have their cached results dropped right away. When the cache grows past `result_cache_max_bytes`, the least recently used results are removed.
+
+# To find where the time of a slow run goes, the condensing and analysis functions can record metrics about each of their calls: the time taken, the rows processed and rows per second, the bytes of the files read and written, and optionally the peak memory allocated. Recording is off unless a `collect_metrics()` block is running, in which case every call inside the block is added to the dictionary it returns, for example:
+#
+# ```python
+# with collect_metrics(memory=True) as metrics:
+#     condense_data(in_file, out_file, city)
+#     length_of_trip(out_file)
+# save_metrics(metrics, 'metrics.json')
+# ```
+#
+# `metrics['calls']` lists every call, with the time of the stages of `condense_data` (reading, condensing and writing), and `metrics['stages']` totals them per function. When no block is running, an instrumented function costs a single check per call.
+
+# In[10]:
 
-        # collect data from and process each row
-        for row in trip_reader:
-            # set up a dictionary to hold the values for the cleaned and trimmed
-            # data point
-            new_point = {}
-
-            ## TODO: use the helper functions to get the cleaned data from  ##
-            ## the original data dictionaries.                              ##
-            ## Note that the keys for the new_point dictionary should match ##
-            ## the column names set in the DictWriter object above.         ##
-            duration = duration_in_mins(row, city)
-            month, hour, day_of_week = time_of_trip(row, city)
-            user_type = type_of_user(row, city)
-            
-            new_point['duration'] = duration
-            new_point['month'] = month
-            new_point['hour'] = hour
-            new_point['day_of_week'] = day_of_week
-            new_point['user_type'] = user_type
-            
-            ## TODO: write the processed information to the output file.     ##
-            ## see https://docs.python.org/3/library/csv.html#writer-objects ##
-            trip_writer.writerow(new_point)
+
+from bikeshare.condense import condense_data
 
 
 # In[11]:
@@ -302,6 +318,40 @@ for city, filenames in city_info.items():
     print_first_point(filenames['out_file'])
 
 
+# Raw files are not always clean: rows get cut short, durations go missing or negative, and a system may rename its user types. `condense_data` checks every row before condensing it. User types are mapped through each city's vocabulary, for example Washington's `Registered` and `Member` both become Subscriber, and anything that cannot be condensed is left out of the summary and written with the reason for it to a quarantine file next to it, `<summary>.quarantine.csv`. `condense_data` returns the number of rows quarantined for each reason.
+
+# In[ ]:
+
+
+import os
+import tempfile
+
+
+dirty_dir = tempfile.mkdtemp()
+with open(os.path.join(dirty_dir, 'dirty.csv'), 'w', newline='') as f_out:
+    writer = csv.writer(f_out)
+    writer.writerow(['Duration (ms)', 'Start date', 'End date', 'Member Type'])
+    writer.writerow(['427387', '3/31/2016 22:57', '3/31/2016 23:04', 'Registered'])
+    writer.writerow(['', '3/31/2016 22:57', '3/31/2016 23:04', 'Registered'])
+    writer.writerow(['-5000', '3/31/2016 22:57', '3/31/2016 23:04', 'Casual'])
+    writer.writerow(['427387', 'yesterday', '3/31/2016 23:04', 'Member'])
+    writer.writerow(['427387', '3/31/2016 22:57', '3/31/2016 23:04', 'Staff'])
+    writer.writerow(['427387', '3/31/2016 22:57'])
+dirty_summary = os.path.join(dirty_dir, 'summary.csv')
+problems = condense_data(os.path.join(dirty_dir, 'dirty.csv'), dirty_summary, 'Washington')
+assert problems == {'missing_duration': 1, 'bad_duration': 1, 'bad_start_time': 1,
+                    'unknown_user_type': 1, 'short_row': 1}
+with open(dirty_summary) as f_in:
+    assert len(list(csv.DictReader(f_in))) == 1
+print(problems)
+
+
+# The loop above condenses one city after another on a single core. `condense_data_parallel(city_info)` does the same work with a pool of processes: the cities are handled concurrently, and files larger than `chunk_bytes` are split into chunks that end at line boundaries, so one large city is condensed by several workers. The condensed chunks are written out in order, giving the same summary files byte for byte as `condense_data`.
+
+# Compressed raw files are read as a single stream, since a compressed file cannot be entered at an arbitrary offset. Gzip files made of many members, as written by `pigz` or by concatenating daily `.gz` files, are the exception: each member can be decompressed on its own. `gzip_member_blocks` finds where members may start (the gzip magic bytes), decompresses from each such offset on a pool of threads, as zlib releases the GIL, and keeps those that turn out to be the next member of the file, in order. A file of a single member, and any member of more than `gzip_member_bytes` of data, is streamed in pieces instead, so a large member is never held in memory whole. `read_text_blocks` turns a file, compressed or not, into blocks of whole lines of text for the pipelined condense below.
+
+# On slow or networked storage, `condense_data` also leaves the disk idle while it parses and the CPU idle while it waits for the disk, as it reads, condenses and writes one row after the other. `condense_data_pipelined` runs these as three stages instead: a reader thread reads the raw file in large blocks of whole lines, a transform thread condenses each block with the adapter of the city, and the writer writes each condensed block with a single `writerows` call through a large buffer. The stages hand blocks to each other through bounded queues, so reading and writing overlap with the parsing while no more than `queue_blocks` blocks wait between two stages. The summary file is the same as `condense_data` writes.
+
 # 
 # <a id='eda'></a>
 # ## Exploratory Data Analysis
@@ -321,37 +371,19 @@ for city, filenames in city_info.items():
 # ### New York City recorded the highest proportion of trips subscribers with approximately **89%**.
 # 
 # ### Chicago has recorded the highest proportion of trips customers with approximately **24%**.
-# 
+#
+# Every question in this section is answered from the same summary files. Rather than re-reading a whole file once per question, `summary_aggregates` scans each summary file once and computes every registered statistic in that single pass. The question functions then read their answers out of the shared result.
+
+# In[ ]:
+
+
+from bikeshare.statistics import read_durations, summary_statistic
+
 
 # In[36]:
 
 
-def number_of_trips(filename):
-    """
-    This function reads in a file with trip data and reports the number of
-    trips made by subscribers, customers, and total overall.
-    """
-    with open(filename) as f_in:
-        # set up csv reader object
-        reader = csv.DictReader(f_in)
-        
-        # initialize count variables
-        n_subscribers = 0
-        n_customers = 0
-        
-        # tally up ride types
-        for row in reader:
-            if row['user_type'] == 'Subscriber':
-                n_subscribers += 1
-            else:
-                n_customers += 1
-        
-        # compute total number of rides
-        n_total = n_subscribers + n_customers
-    
-        
-        # return tallies as a tuple
-        return(n_subscribers, n_customers, n_total)
+from bikeshare.statistics import number_of_trips
 
 
 # In[37]:
@@ -407,28 +439,7 @@ for city, filename in city_info.items():
 ## TIP: For the Bay Area example, the average trip length is 14 minutes ##
 ## and 3.5% of trips are longer than 30 minutes.                        ##
 
-def length_of_trip(filename):
-    with open(filename) as f_in:
-        reader = csv.DictReader(f_in)
-        
-        trip_under_30 = 0
-        trip_above_30 = 0
-        time_of_trip = 0
-
-        for row in reader:
-            time_of_trip += float(row['duration'])
-
-            if float(row['duration']) > 30:
-                trip_above_30 += 1
-            else: 
-                trip_under_30 += 1
-                total_of_trips = trip_under_30 + trip_above_30
-
-        avg_length = round(time_of_trip / total_of_trips,1)
-        trips_longer_30 = round(float(trip_above_30 / total_of_trips)*100, 1)
-        trips_less_30 =round(float(trip_under_30 / total_of_trips)*100, 1)
-        
-        return (avg_length, trips_longer_30)
+from bikeshare.statistics import length_of_trip
 
 
 # In[39]:
@@ -475,28 +486,8 @@ for city, filename in city_data.items():
 ## Subscriber trip duration to be 9.5 minutes and the average Customer ##
 ## trip duration to be 54.6 minutes. Do the other cities have this     ##
 ## level of difference?                                                ##
-def duration_ridership(filename):
-    
-    with open(filename) as f_in:
-        reader = csv.DictReader(f_in)
-        subscibers = 0
-        sub_length = 0
-        customers = 0
-        cus_length = 0
-        for row in reader:
-            user_type = row['user_type']
-            duration = float(row['duration'])
-            if user_type == 'Customer':
-                customers += 1
-                cus_length += duration
-            else:
-                subscibers += 1
-                sub_length += duration
-            
-        sub_avg = round(sub_length / subscibers, 1)
-        cus_avg = round(cus_length /customers, 1)
-        total_users = subscibers + customers
-        return (subscibers, customers, sub_avg, cus_avg, total_users)
+
+from bikeshare.statistics import duration_ridership
 
 
 # In[29]:
@@ -556,16 +547,11 @@ plt.show()
 ## and then use pyplot functions to generate a histogram of trip times.     ##
 filename='./data/Chicago-2016-Summary.csv'
 
-def visualize_trip_time(filename):
-    data=[]
-    with open(filename) as f_in:
-        reader=csv.DictReader(f_in)
-        for row in reader:
-            data.append(float(row['duration']))
-    return data
-                             
-trip_time = visualize_trip_time(filename)
-plt.hist(trip_time)
+from bikeshare.statistics import duration_histogram
+
+
+counts, edges = duration_histogram(filename, 10)
+plt.stairs(counts, edges, fill=True)
 plt.title('city: ' + city)
 plt.xlabel('Duration of trip')
 plt.ylabel('Count of users')
@@ -585,24 +571,19 @@ plt.show()
 
 
 ## Use this and additional cells to answer Question 5. ##
-sub_data=[]
+
+from bikeshare.statistics import user_type_durations
 
 def duration_of_sub_users(filename):
     
-    with open(filename) as f_in:
-        reader=csv.DictReader(f_in)
-        for row in reader:
-            if row['user_type'] =='Subscriber':
-                if float(row['duration'])<75:
-                    sub_data.append(float(row['duration']))
-        return sub_data
+    return user_type_durations(filename, 'Subscriber', 75)
     
                 
 filename='./data/NYC-2016-Summary.csv'
 plt.title('Trip distribution for Subscribers in ' + city + ' city')
-duration_of_sub_plot = duration_of_sub_users(filename)
 bins= range(0,75,5)
-plt.hist(duration_of_sub_plot, bins)
+counts, edges = duration_histogram(filename, bins, 'Subscriber')
+plt.stairs(counts, edges, fill=True)
 plt.xlabel('Trip Duration (minutes)')
 plt.ylabel('Count of Subscriber users')
 plt.show()
@@ -611,20 +592,13 @@ plt.show()
 # In[35]:
 
 
-cust_data=[]
 def duration_of_cus_users(filename):
-    with open(filename) as f_in:
-        reader=csv.DictReader(f_in)
-        for row in reader:
-            if row['user_type'] =='Customer':
-                if float(row['duration'])<75:
-                    cust_data.append(float(row['duration']))
-        return cust_data
+    return user_type_durations(filename, 'Customer', 75)
 filename='./data/NYC-2016-Summary.csv'
 plt.title('Trip distribution for Customer in ' + city + ' city')
-duration_of_cus_plot = duration_of_cus_users(filename)
 bins= range(0,75,5)
-plt.hist(duration_of_cus_plot, bins)
+counts, edges = duration_histogram(filename, bins, 'Customer')
+plt.stairs(counts, edges, fill=True)
 plt.xlabel('Trip Duration(mins)')
 plt.ylabel('Count of Customer users')
 plt.show()
@@ -656,36 +630,22 @@ plt.show()
 # In[33]:
 
 
+from bikeshare.statistics import monthly_trips
+
 def total_customers_and_subscribers(filename):
   
-    with open(filename) as f_in:
-        reader = csv.DictReader(f_in)
-        month_trip_sub={}
-        sub_info=[]
-        month_trip_cus={}
-        cus_info=[]
-        
-        for i in range(1,13):
-            month_trip_sub[str(i)]=0
-            month_trip_cus[str(i)]=0 
-        for row in reader:
-            if row['user_type']=='Customer':
-                month_trip_cus[row['month']]+=1
-            else:
-                month_trip_sub[row['month']]+=1
-        cus_info = month_trip_cus.values()
-        sub_info = month_trip_sub.values()
-        bins = range(1,13,1)
-        plt.bar(bins,sub_info,color='y',width=0.6,label ='Subscriber')
-        plt.bar(bins,cus_info,color='b',width=0.6,label ='Customer')
-        
-        plt.title('Total of Customers and Subscribers per months')
-        plt.xlabel("Month")
-        months=['Jan','Feb','Mar','Apr','may','Jun','July','Aug','Sep','Oct','Nov','Dec']
-        plt.xticks(bins,months)
-        plt.ylabel("count of users")
-        plt.legend()
-        plt.show()
+    sub_info, cus_info = monthly_trips(filename)
+    bins = range(1,13,1)
+    plt.bar(bins,sub_info,color='y',width=0.6,label ='Subscriber')
+    plt.bar(bins,cus_info,color='b',width=0.6,label ='Customer')
+
+    plt.title('Total of Customers and Subscribers per months')
+    plt.xlabel("Month")
+    months=['Jan','Feb','Mar','Apr','may','Jun','July','Aug','Sep','Oct','Nov','Dec']
+    plt.xticks(bins,months)
+    plt.ylabel("count of users")
+    plt.legend()
+    plt.show()
 
 
 # In[34]:
@@ -702,6 +662,274 @@ for datafile, filename in data_file.items():
     
 
 
+# The charts above are drawn one at a time with `plt.show()`. To regenerate them for many cities, as the pictures in `images/` were, `render_charts` saves every chart of every city to files instead, without a display: `chart_aggregates` gathers the few numbers each chart is drawn from, the charts are drawn on the Agg backend by a pool of processes that each reuse one figure per chart, and a chart is skipped when the hash of its numbers is the same as when it was last saved. The same is done from the command line with `python -m bikeshare report ... --charts DIRECTORY`.
+
+# In[ ]:
+
+
+from bikeshare.plots import chart_aggregates, render_charts
+
+
+chart_dir = tempfile.mkdtemp()
+aggregates = {city: chart_aggregates(filename) for city, filename in data_file.items()}
+paths = render_charts(aggregates, chart_dir, formats=('png', 'svg'))
+print('Saved {} charts'.format(len(paths)))
+# nothing has changed since, so no chart is drawn again
+assert render_charts(aggregates, chart_dir, formats=('png', 'svg')) == []
+
+
+# <a id='scaling'></a>
+# ## Scaling Up the Analysis
+#
+# The functions above work one trip at a time on dictionaries built by `csv.DictReader`, which is fine for a 2% sample but slow on the full-year files. The cells below load a whole file into typed NumPy columns instead: durations as `float32`, month and hour as `uint8`, and day of week and user type as small categorical codes. The statistics can then be computed with array reductions, giving the same answers as the functions above.
+
+# The binary summary files written by `condense_data` are read with `np.memmap`: the records stay on disk and are paged in by the operating system as they are used, and every column is a view into the mapped records rather than a copy.
+
+# In[ ]:
+
+
+## Vectorized versions of the statistics functions. Each one returns the same
+## answer as the function of the same name without the '_vectorized' suffix.
+## Sums are accumulated in float64 so the float32 durations lose no accuracy.
+
+from bikeshare.columns import (number_of_trips_vectorized,
+                               length_of_trip_vectorized,
+                               duration_ridership_vectorized)
+
+
+# We get new trip data every day, and condensing the full year again for every drop is wasteful. `condense_data_incremental` only condenses the rows of a raw file it has not seen yet and appends them to the city's summary. It keeps, next to the summary, how far it got in each raw file along with running totals of the trip counts and durations per user type, the trips longer than 30 minutes and the trips per month. `number_of_trips`, `length_of_trip`, `duration_ridership` and `total_customers_and_subscribers` read those totals directly instead of scanning the summary again.
+
+# In[ ]:
+
+
+for city, filename in city_data.items():
+    assert number_of_trips_vectorized(filename) == number_of_trips(filename)
+    assert length_of_trip_vectorized(filename) == length_of_trip(filename)
+    assert duration_ridership_vectorized(filename) == duration_ridership(filename)
+
+
+# To catch performance regressions before they reach the nightly job, `bikeshare.benchmark` benchmarks the hot paths. `write_synthetic_city` generates a raw file of any size in the exact format of each city, and `run_benchmarks` times every stage on it: condensing, the city adapter, the parsing of start times, loading the columns and each statistics function. Each stage runs in a forked process of its own so its peak memory can be told apart, and the results are saved as JSON to compare between commits with `compare_benchmarks`, for example:
+#
+# ```python
+# run_benchmarks('bench.json', n_rows=10**6)
+# compare_benchmarks('bench-before.json', 'bench.json')
+# ```
+#
+# `run_benchmarks` also times the cold start of the command line interface, a fresh interpreter importing `bikeshare.cli`, against `cold_start_budget`. The report only needs the statistics, so numpy and matplotlib stay off that path and are only imported by the commands and charts that use them.
+
+# The columnar loader above keeps a whole file in memory, which breaks down on multi-year or multi-city inputs larger than the machine's memory. `out_of_core_statistics` computes the statistics of any number of summary or raw files one block at a time instead: each block is summarized with array operations into a partial result (counts, sums, ranges, histograms and monthly tables), which is merged into the running total and then dropped. The merges are associative, so the result does not depend on how the files are cut into blocks, and partial results computed elsewhere, for example by other processes, can be merged in the same way with `merge_statistics`. The block size follows from `memory_budget`, so peak memory stays flat however large the input grows.
+
+# `length_of_trip` and `duration_ridership` take their averages from streaming moments of the durations kept for each user type: the count, the mean, the variance, and the shortest and longest trip. The total is kept with compensated (Kahan-Neumaier) summation and the variance with Welford's update, so neither loses accuracy over millions of trips, and the moments of chunks, processes or cities merge exactly like the other statistics. `duration_statistics` reports them, and the results of a serial scan and of a merge of parts agree to within `moments_tolerance`, relatively.
+
+# In[ ]:
+
+
+import statistics
+
+from bikeshare.moments import moments_summary, moments_tolerance
+from bikeshare.outofcore import out_of_core_statistics
+from bikeshare.statistics import duration_statistics
+
+
+for city, filename in city_data.items():
+    durations = [duration for duration, user_type in read_durations(filename)]
+    result = duration_statistics(filename)
+    # the statistics module sums the durations exactly
+    assert abs(result['mean'] - statistics.fmean(durations)) <= moments_tolerance * result['mean']
+    assert abs(result['variance'] - statistics.variance(durations)) <= moments_tolerance * result['variance']
+    # merged from blocks of about a thousand trips
+    merged = out_of_core_statistics([(filename, None)], memory_budget=1)['duration_moments']
+    for user_type, moments in merged.items():
+        parts = moments_summary(moments)
+        serial = duration_statistics(filename, user_type)
+        assert parts['count'] == serial['count']
+        assert abs(parts['stddev'] - serial['stddev']) <= moments_tolerance * serial['stddev']
+    print('{}: {:.1f} +/- {:.1f} minutes, from {:.1f} to {:.1f} minutes'.format(
+        city, result['mean'], result['stddev'], result['min'], result['max']))
+
+
+# The statistics so far only give mean durations, which long outliers pull upwards. The duration sketches counted by every scan give bounded-error percentiles instead, by user type, month and hour, without sorting every duration. `summary_sketches` saves them next to a summary file as `<summary>.sketches.json`, so they are only computed again when the summary changes, and sketches of different chunks or cities can be combined with `merge_duration_sketches`.
+
+# In[ ]:
+
+
+import bisect
+
+from bikeshare.statistics import duration_percentiles
+
+
+for city, filename in city_data.items():
+    durations = sorted(duration for duration, user_type in read_durations(filename))
+    for p, estimate in duration_percentiles(filename).items():
+        # the rank of the estimate is within 2% of the trips of the exact one
+        rank = bisect.bisect_left(durations, estimate)
+        assert abs(rank - p / 100 * len(durations)) <= 0.02 * len(durations) + 1
+    print('{}: median trip {:.1f} minutes, 90th percentile {:.1f} minutes'.format(
+        city, duration_percentiles(filename)[50], duration_percentiles(filename)[90]))
+
+
+# The condensed files keep no trace of where trips start and end, which rebalancing the bikes between stations needs. `od_matrix` reads a raw city file in one streaming pass and counts the trips and their total duration for every route, a pair of start and end stations, along with the trips leaving and arriving at each station in every hour of the day. Stations get compact integer codes in the order they are first seen, and routes are kept as a sparse matrix in coordinate (COO) form, sorted by start and end station, so memory grows with the number of distinct routes rather than trips. `od_csr` turns it into compressed sparse rows for fast lookups of the routes from one station; `top_routes` and `station_imbalance` answer the busiest routes and the stations that bikes drain from or pile up at. The check below runs on a raw file of random trips from `write_synthetic_city`, whose routes are also counted row by row.
+
+# In[ ]:
+
+
+from collections import Counter
+
+from bikeshare.benchmark import write_synthetic_city
+from bikeshare.stations import (od_matrix, od_csr, route_trips, top_routes,
+                                station_imbalance)
+
+
+# a raw Washington file of random trips between 600 stations
+stations_file = os.path.join(tempfile.mkdtemp(), 'Washington-synthetic.csv')
+write_synthetic_city(stations_file, 'Washington', 20000)
+matrix = od_matrix(stations_file, 'Washington')
+assert matrix['count'].sum() == matrix['outflow'].sum() == matrix['inflow'].sum() == 20000
+# the matrix gives the same trips per route as counting every row
+with open(stations_file) as f_in:
+    route_counts = Counter((row['Start station number'], row['End station number'])
+                           for row in csv.DictReader(f_in))
+assert sorted(matrix['count'].tolist()) == sorted(route_counts.values())
+csr = od_csr(matrix)
+for origin, destination, trips, mean_duration in top_routes(matrix, 3):
+    assert route_trips(matrix, csr, origin, destination) == (trips, mean_duration)
+    assert route_counts[(origin, destination)] == trips
+    print('{} -> {}: {} trips of {:.1f} minutes'.format(origin, destination,
+                                                         trips, mean_duration))
+morning = station_imbalance(matrix, hour=8)
+print('Station losing the most bikes at 8am:', min(morning, key=morning.get))
+
+
+# The end times of the trips also tell how many bikes are out at any moment, which sizes the fleet needed at peak demand. Rather than checking every trip against every minute of the year, `bikes_in_use` sweeps over the trips once: each trip adds one to the bucket it starts in and removes one after the bucket it ends in, and a cumulative sum over this difference array gives the number of trips under way in every bucket, in O(trips + buckets) time. Below it runs on the synthetic file of the routes above and is checked against adding every trip to each hour it overlaps.
+
+# In[ ]:
+
+
+from datetime import timedelta
+
+from bikeshare.stations import bikes_in_use, peak_buckets
+
+
+timeline = bikes_in_use(stations_file, 'Washington', bucket_minutes=60)
+# the sweep gives the same counts as adding every trip to each hour it
+# overlaps, one hour at a time
+brute_force = Counter()
+with open(stations_file) as f_in:
+    for row in csv.DictReader(f_in):
+        start = datetime.strptime(row['Start date'], '%m/%d/%Y %H:%M')
+        end = datetime.strptime(row['End date'], '%m/%d/%Y %H:%M')
+        hour = start.replace(minute=0)
+        while hour <= end:
+            brute_force[hour] += 1
+            hour += timedelta(hours=1)
+assert {timeline['start'] + timedelta(hours=i): int(in_use)
+        for i, in_use in enumerate(timeline['in_use']) if in_use} == brute_force
+busiest, in_use = peak_buckets(timeline, 1)[0]
+assert brute_force[busiest] == in_use == max(brute_force.values())
+print('Most bikes in use: {} in the hour from {}'.format(in_use, busiest))
+
+
+# Summary files condensed before trip cubes existed need not be condensed again: `cube_from_summary` builds the same cube from the columns of a summary file. Below, the cube answers the monthly counts of Question 7 and a new slice, the trips of Customers by hour on weekends, without reading the trips again.
+
+# In[ ]:
+
+
+from bikeshare.cube import cube_from_summary, cube_query
+
+
+for city, filename in city_data.items():
+    cube = cube_from_summary(filename)
+    sub, cus = monthly_trips(filename)
+    assert cube_query(cube, by=['month'], user_type='Subscriber').tolist() == sub
+    assert cube_query(cube, by=['month'], user_type='Customer').tolist() == cus
+    assert cube_query(cube, 'long_trips') == summary_statistic(filename, 'trip_length')[2]
+    weekend = cube_query(cube, by=['hour'], user_type='Customer',
+                         day_of_week=['Saturday', 'Sunday'])
+    print('{}: busiest weekend hour for Customers is {}:00'.format(city, weekend.argmax()))
+
+
+# A question such as "how long are the trips of Customers in July between 17:00 and 19:00?" only concerns a small part of a summary file, yet `duration_of_cus_users` and the other functions above read all of it. `condense_data(..., index=True)` also saves a block index next to the summary: for every block of 4096 rows, its byte range in the file, the range of its durations, months and hours, and bitmaps of the user types and days of the week in it. `summary_index` builds the same index for a summary condensed without one. `filtered_trips` and `query_trips` then only read the blocks that can hold matching trips; as the trips are in the order of their start times, a filter on the month skips most of the file.
+
+# In[ ]:
+
+
+from bikeshare.adapters import summary_user_types
+from bikeshare.index import filtered_trips, query_trips, trip_matcher
+
+
+for city, filename in city_data.items():
+    evening = trip_matcher('Customer', months=7, hours=range(17, 19))
+    # a row cut short, with no user type or only part of one, is skipped
+    # by the index as well
+    with open_data_file(filename) as f_in:
+        trips = [(float(row['duration']), int(row['month']), int(row['hour']),
+                  row['day_of_week'], summary_user_types[row['user_type']])
+                 for row in csv.DictReader(f_in)
+                 if row['user_type'] in summary_user_types]
+    assert list(filtered_trips(filename, 'Customer', 7, range(17, 19))) == [
+        trip for trip in trips if evening(trip)]
+    result = query_trips(filename, 'Customer', 7, range(17, 19))
+    print('{}: {} Customer trips in July from 17:00 to 19:00, read {} of {} blocks'.format(
+        city, result['trips'], result['blocks_read'], result['blocks']))
+
+
+# Every question so far is answered by reading a summary file again, in each process that asks. With `database`, `condense_data` also loads the condensed trips of the city into an SQLite database, replacing the trips it had in a single transaction, with `executemany` inserting a block of rows at a time; `load_summary` does the same for a summary file condensed before. All cities share one table indexed on city, month, hour and user type, and `number_of_trips_sql`, `length_of_trip_sql`, `duration_ridership_sql` and `monthly_trips_sql` answer the questions above with aggregate queries on the index. The database is in write-ahead log mode, so any number of readers can query it while a city is reloaded.
+
+# In[ ]:
+
+
+from bikeshare.database import (database_cities, duration_ridership_sql,
+                                length_of_trip_sql, load_summary,
+                                monthly_trips_sql, number_of_trips_sql)
+
+
+database = os.path.join(tempfile.mkdtemp(), 'trips.db')
+for city, filename in city_data.items():
+    load_summary(database, filename, city)
+    assert number_of_trips_sql(database, city) == number_of_trips(filename)
+    assert length_of_trip_sql(database, city) == length_of_trip(filename)
+    assert duration_ridership_sql(database, city) == duration_ridership(filename)
+    assert monthly_trips_sql(database, city) == monthly_trips(filename)
+print('Cities in the database:', ', '.join(database_cities(database)))
+
+
+# A report run from the command line loads and parses every summary file again. `python -m bikeshare serve` instead starts a long-running service that loads the summary files once into numpy columns and answers the statistics over HTTP as JSON, on a local port or a Unix socket: the report of each city, the trips per user type, the average duration and share of trips over 30 minutes, the averages by user type, the monthly trips and duration histograms, at paths such as `/cities/NYC/monthly` or `/cities/NYC/histogram?bins=10&user_type=Customer`. The answers are computed as a city loads, so a request is little more than a dictionary lookup, and requests are handled on a pool of threads. The service checks the files every second and reloads a city whose summary has changed. `start_service` runs the same service inside a process, which is how it is tested below on localhost.
+
+# In[ ]:
+
+
+import shutil
+import time
+
+from bikeshare.cli import summary_report
+from bikeshare.service import (query_service, service_connection, start_service,
+                               stop_service)
+
+
+served = {city: shutil.copy(filename, tempfile.mkdtemp())
+          for city, filename in city_data.items()}
+service = start_service(served, ('127.0.0.1', 0), reload_interval=0.1)
+connection = service_connection(service['address'])
+for city, filename in served.items():
+    status, report = query_service(connection, '/cities/' + city)
+    assert status == 200 and report == dict(summary_report(filename), city=city)
+    status, histogram = query_service(connection, '/cities/{}/histogram?bins=10'.format(city))
+    assert (histogram['counts'], histogram['edges']) == duration_histogram(filename, 10)
+
+start = time.perf_counter()
+for i in range(100):
+    query_service(connection, '/cities/NYC/trips')
+print('{:.2f} ms per request'.format((time.perf_counter() - start) * 10))
+
+# the service picks up a new summary of Washington
+shutil.copy(city_data['Chicago'], served['Washington'])
+time.sleep(0.5)
+assert query_service(connection, '/cities/Washington/trips')[1] == \
+    query_service(connection, '/cities/Chicago/trips')[1]
+connection.close()
+stop_service(service)
+
+
 # ###### <a id='conclusions'></a>
 # ## Conclusions
 # 
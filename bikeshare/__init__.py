@@ -0,0 +1,9 @@
+"""
+Statistics of the trips of the bike share systems of NYC, Chicago and
+Washington, from raw data files condensed into summary files.
+
+The modules are imported on demand, so importing the package is cheap and
+the ones needing numpy or matplotlib are only loaded when used.
+"""
+
+__version__ = '0.1.0'
@@ -0,0 +1,260 @@
+"""
+The per-city adapters that turn a row of a raw data file into the
+duration, month, hour, day of the week and user type of its trip, and
+tell why a row that cannot be turned into a trip was rejected.
+"""
+
+import math
+from datetime import datetime
+
+from .parsing import parse_start_time, parse_start_times
+
+
+# divisor from each unit of trip durations to minutes
+duration_units = {'ms': 60000, 's': 60, 'min': 1}
+
+
+# city -> description of its raw data files
+city_adapters = {}
+
+
+def register_city(city, duration_column, duration_unit, start_column,
+                  clock_format, user_column, user_types=None,
+                  other_user_type=None, date_format='%m/%d/%Y',
+                  end_column=None, start_station_column=None,
+                  end_station_column=None):
+    """
+    Describes the raw data files of a city: the names of the duration, start
+    time and user type columns, the unit of the durations (a key of
+    duration_units), and the format of the start times, a date_format and a
+    clock_format separated by a space. user_types maps the user types of the
+    city to Subscriber or Customer; values it does not list become
+    other_user_type if it is given, and are rejected otherwise. With
+    user_types None, the user types are kept as they are. A blank user type
+    is rejected unless user_types maps the empty string. The end time
+    (in the format of the start time) and start and end station columns are
+    optional, and only used by the station analysis.
+    """
+    city_adapters[city] = {'duration_column': duration_column,
+                           'divisor': duration_units[duration_unit],
+                           'start_column': start_column,
+                           'date_format': date_format,
+                           'clock_format': clock_format,
+                           'user_column': user_column,
+                           'user_types': user_types,
+                           'other_user_type': other_user_type,
+                           'end_column': end_column,
+                           'start_station_column': start_station_column,
+                           'end_station_column': end_station_column}
+
+
+# the user types of the files of most cities are already Subscriber or Customer
+subscriber_or_customer = {'Subscriber': 'Subscriber', 'Customer': 'Customer'}
+
+
+register_city('NYC', 'tripduration', 's', 'starttime', '%H:%M:%S', 'usertype',
+              user_types=subscriber_or_customer, end_column='stoptime',
+              start_station_column='start station id',
+              end_station_column='end station id')
+
+
+register_city('Chicago', 'tripduration', 's', 'starttime', '%H:%M', 'usertype',
+              user_types=subscriber_or_customer, end_column='stoptime',
+              start_station_column='from_station_id',
+              end_station_column='to_station_id')
+
+
+register_city('Washington', 'Duration (ms)', 'ms', 'Start date', '%H:%M',
+              'Member Type',
+              user_types={'Registered': 'Subscriber', 'Member': 'Subscriber',
+                          'Casual': 'Customer'},
+              end_column='End date',
+              start_station_column='Start station number',
+              end_station_column='End station number')
+
+
+register_city('BayArea', 'Duration', 's', 'Start Date', '%H:%M',
+              'Subscription Type', user_types=subscriber_or_customer,
+              end_column='End Date', start_station_column='Start Terminal',
+              end_station_column='End Terminal')
+
+
+# user types found in summary files, including those condensed before the
+# user types of every city were mapped, and the user type each stands for
+summary_user_types = {'Subscriber': 'Subscriber', 'Customer': 'Customer',
+                      'Registered': 'Subscriber', 'Member': 'Subscriber',
+                      'Casual': 'Customer'}
+
+
+def summary_user_type(value):
+    """
+    Returns the user type, Subscriber or Customer, of a user type read from
+    a summary file, and raises ValueError for any other value.
+    """
+    user_type = summary_user_types.get(value)
+    if user_type is None:
+        raise ValueError('unknown user type in summary file: {!r}'.format(value))
+    return user_type
+
+
+def parse_summary_rows(rows, columns, malformed):
+    """
+    Returns the (duration, month, hour, day_of_week, user_type) trips of rows
+    of a summary file read by csv.reader, columns being the positions of
+    those five columns in a row. Blank rows are ignored, and rows that do not
+    parse, such as a last row cut short, are appended to malformed instead.
+    """
+    i_duration, i_month, i_hour, i_day, i_user = columns
+    trips = []
+    for row in rows:
+        if not row:
+            continue
+        try:
+            trips.append((float(row[i_duration]), int(row[i_month]), int(row[i_hour]),
+                          row[i_day], summary_user_types.get(row[i_user]) or
+                          summary_user_type(row[i_user])))
+        except (ValueError, IndexError):
+            malformed.append(row)
+    return trips
+
+
+def adapter_columns(adapter, header):
+    """
+    Returns the positions of the duration, start time and user type columns
+    of a city in the header row of one of its files.
+    """
+    return [header.index(adapter[column]) for column in
+            ['duration_column', 'start_column', 'user_column']]
+
+
+def start_time_parser(adapter):
+    """
+    Returns a function parsing a list of start time strings of a city into
+    the lists of their months, hours and days of the week.
+    """
+    clock_format = adapter['clock_format']
+    if adapter['date_format'] == '%m/%d/%Y':
+        return lambda values: parse_start_times(values, clock_format)
+
+    time_format = adapter['date_format'] + ' ' + clock_format
+    def parse(values):
+        times = [datetime.strptime(value, time_format) for value in values]
+        return ([d.month for d in times], [d.hour for d in times],
+                [d.strftime('%A') for d in times])
+    return parse
+
+
+def keep_user_type(value):
+    if not value:
+        raise ValueError('blank user type')
+    return value
+
+
+def user_type_mapper(adapter):
+    """
+    Returns a function from a user type value of a city to its user type,
+    which raises KeyError or ValueError for a value the city rejects.
+    """
+    user_types = adapter['user_types']
+    if user_types is None:
+        return keep_user_type
+    other = adapter['other_user_type']
+    if other is None:
+        return user_types.__getitem__
+    return lambda value: user_types.get(value, other) if value else user_types[value]
+
+
+def compile_city_adapter(city, header):
+    """
+    Returns a function from a row of a raw file of a city, as a list of
+    strings read by csv.reader, to its condensed values as a tuple (duration,
+    month, hour, day_of_week, user_type). header is the first row of the
+    file. The function raises ValueError, KeyError or IndexError for a row
+    that is not a valid trip; row_problem tells why.
+    """
+    adapter = city_adapters[city]
+    i_duration, i_start, i_user = adapter_columns(adapter, header)
+    divisor = adapter['divisor']
+    map_user_type = user_type_mapper(adapter)
+    infinity = math.inf
+
+    if adapter['date_format'] == '%m/%d/%Y':
+        clock_format = adapter['clock_format']
+        parse = lambda value: parse_start_time(value, clock_format)
+    else:
+        parse_times = start_time_parser(adapter)
+        parse = lambda value: tuple(column[0] for column in parse_times([value]))
+
+    def transform(row):
+        month, hour, day_of_week = parse(row[i_start])
+        duration = float(row[i_duration]) / divisor
+        # also false for nan
+        if not 0 <= duration < infinity:
+            raise ValueError('duration out of range')
+        return (duration, month, hour, day_of_week, map_user_type(row[i_user]))
+    return transform
+
+
+# reason codes of the rows of raw files that are not valid trips, in the
+# order they are checked
+row_problems = ['short_row', 'missing_duration', 'bad_duration',
+                'missing_start_time', 'bad_start_time', 'missing_user_type',
+                'unknown_user_type', 'bad_row']
+
+
+def compile_row_problem(city, header):
+    """
+    Returns a function from a row of a raw file of a city that
+    compile_city_adapter rejects to the code of its first problem, one of
+    row_problems.
+    """
+    adapter = city_adapters[city]
+    i_duration, i_start, i_user = adapter_columns(adapter, header)
+    map_user_type = user_type_mapper(adapter)
+    parse_times = start_time_parser(adapter)
+
+    def problem(row):
+        if len(row) <= max(i_duration, i_start, i_user):
+            return 'short_row'
+        if not row[i_duration].strip():
+            return 'missing_duration'
+        try:
+            if not 0 <= float(row[i_duration]) < math.inf:
+                return 'bad_duration'
+        except ValueError:
+            return 'bad_duration'
+        if not row[i_start].strip():
+            return 'missing_start_time'
+        try:
+            parse_times([row[i_start]])
+        except ValueError:
+            return 'bad_start_time'
+        if not row[i_user].strip():
+            return 'missing_user_type'
+        try:
+            map_user_type(row[i_user])
+        except (KeyError, ValueError):
+            return 'unknown_user_type'
+        return 'bad_row'
+    return problem
+
+
+def condense_rows(transform, problem, rows, quarantined):
+    """
+    Returns the condensed values of a list of rows, leaving out empty rows.
+    The rows transform rejects are left out too, and appended to the list
+    quarantined as [reason] + row. Blocks without a bad row, nearly all of
+    them, take a single pass.
+    """
+    try:
+        return [transform(row) for row in rows if row]
+    except (ValueError, KeyError, IndexError):
+        pass
+    block = []
+    for row in rows:
+        if row:
+            try:
+                block.append(transform(row))
+            except (ValueError, KeyError, IndexError):
+                quarantined.append([problem(row)] + row)
+    return block
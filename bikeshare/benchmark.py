@@ -0,0 +1,296 @@
+"""
+Benchmarks of every stage on synthetic data files, including the cold
+start of the command line interface.
+"""
+
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from . import cache
+from .adapters import city_adapters, compile_city_adapter
+from .cache import file_hashes
+from .columns import column_loads, load_trip_columns
+from .condense import condense_data
+from .files import open_data_file
+from .instrumentation import peak_rss_bytes
+from .parsing import parse_start_times, trip_dates, trip_hours, trip_minutes
+from .statistics import (duration_ridership, length_of_trip, monthly_trips,
+                         number_of_trips, scan_summary, summary_scans)
+
+
+# header of the raw data file of each city
+raw_headers = {
+    'NYC': ['tripduration', 'starttime', 'stoptime', 'start station id',
+            'start station name', 'start station latitude',
+            'start station longitude', 'end station id', 'end station name',
+            'end station latitude', 'end station longitude', 'bikeid',
+            'usertype', 'birth year', 'gender'],
+    'Chicago': ['trip_id', 'starttime', 'stoptime', 'bikeid', 'tripduration',
+                'from_station_id', 'from_station_name', 'to_station_id',
+                'to_station_name', 'usertype', 'gender', 'birthyear'],
+    'Washington': ['Duration (ms)', 'Start date', 'End date',
+                   'Start station number', 'Start station',
+                   'End station number', 'End station', 'Bike number',
+                   'Member Type']}
+
+
+def synthetic_time(d, with_seconds):
+    text = '{}/{}/{} {:02d}:{:02d}'.format(d.month, d.day, d.year, d.hour, d.minute)
+    if with_seconds:
+        text += ':{:02d}'.format(d.second)
+    return text
+
+
+def synthetic_row(city, rng, trip_id):
+    """
+    Returns one random trip of 2016 as a row of the raw data file of a city.
+    """
+    start = datetime(2016, 1, 1) + timedelta(seconds=rng.randrange(366 * 86400))
+    seconds = int(rng.lognormvariate(6.5, 0.8)) + 60
+    end = start + timedelta(seconds=seconds)
+    subscriber = rng.random() < 0.85
+    from_station = rng.randrange(1, 600)
+    to_station = rng.randrange(1, 600)
+    bike = rng.randrange(10000, 30000)
+
+    if city == 'NYC':
+        return [seconds, synthetic_time(start, True), synthetic_time(end, True),
+                from_station, 'Station {}'.format(from_station),
+                '40.7{:04d}'.format(from_station), '-73.9{:04d}'.format(from_station),
+                to_station, 'Station {}'.format(to_station),
+                '40.7{:04d}'.format(to_station), '-73.9{:04d}'.format(to_station),
+                bike, 'Subscriber' if subscriber else 'Customer',
+                rng.randrange(1940, 2000) if subscriber else '',
+                rng.randrange(3) if subscriber else 0]
+    elif city == 'Chicago':
+        return [trip_id, synthetic_time(start, False), synthetic_time(end, False),
+                bike, seconds, from_station, 'Station {}'.format(from_station),
+                to_station, 'Station {}'.format(to_station),
+                'Subscriber' if subscriber else 'Customer',
+                rng.choice(['Male', 'Female']) if subscriber else '',
+                rng.randrange(1940, 2000) if subscriber else '']
+    else:
+        return [seconds * 1000 + rng.randrange(1000), synthetic_time(start, False),
+                synthetic_time(end, False), 31000 + from_station,
+                'Station {}'.format(from_station), 31000 + to_station,
+                'Station {}'.format(to_station), 'W{}'.format(bike),
+                'Registered' if subscriber else 'Casual']
+
+
+def write_synthetic_city(filename, city, n_rows, seed=2016):
+    """
+    Writes a raw data file of n_rows random trips in the format of the data
+    file of a city. The same seed always gives the same file.
+    """
+    rng = random.Random(seed)
+    with open(filename, 'w') as f_out:
+        trip_writer = csv.writer(f_out)
+        trip_writer.writerow(raw_headers[city])
+        for first in range(0, n_rows, 10000):
+            trip_writer.writerows(synthetic_row(city, rng, trip_id)
+                                  for trip_id in range(first, min(first + 10000, n_rows)))
+
+
+def forget_parsed_data():
+    """
+    Empties the in-memory tables and caches, so a stage starts from scratch.
+    """
+    for table in [trip_dates, trip_hours, summary_scans, column_loads, file_hashes]:
+        table.clear()
+    for table in trip_minutes.values():
+        table.clear()
+
+
+def sample_rows(filename, n_rows):
+    """
+    Returns the header and first n_rows rows of a raw data file.
+    """
+    with open_data_file(filename) as f_in:
+        trip_reader = csv.reader(f_in)
+        return next(trip_reader), list(itertools.islice(trip_reader, n_rows))
+
+
+def benchmark_stages(raw_file, summary_file, city, sample_size):
+    """
+    Returns {name: (function, number of rows it handles)} for every stage
+    benchmarked on a raw file and the summary file condensed from it.
+    """
+    def adapter_stage():
+        transform = compile_city_adapter(city, header)
+        for row in sample:
+            transform(row)
+
+    def parse_stage():
+        adapter = city_adapters[city]
+        i_start = header.index(adapter['start_column'])
+        parse_start_times([row[i_start] for row in sample], adapter['clock_format'])
+
+    header, sample = sample_rows(raw_file, sample_size)
+    with open(summary_file) as f_in:
+        n_rows = sum(1 for line in f_in) - 1
+    return {
+        'condense_data': (lambda: condense_data(raw_file, summary_file, city), n_rows),
+        'city_adapter': (adapter_stage, len(sample)),
+        'parse_start_times': (parse_stage, len(sample)),
+        'scan_summary': (lambda: scan_summary(summary_file), n_rows),
+        'load_trip_columns': (lambda: load_trip_columns(summary_file), n_rows),
+        'number_of_trips': (lambda: number_of_trips(summary_file), n_rows),
+        'length_of_trip': (lambda: length_of_trip(summary_file), n_rows),
+        'duration_ridership': (lambda: duration_ridership(summary_file), n_rows),
+        'monthly_trips': (lambda: monthly_trips(summary_file), n_rows)}
+
+
+def measure_stage(function, n_rows):
+    """
+    Runs a stage twice, once timed and once under tracemalloc, and returns its
+    metrics. Meant to run in a process of its own. CPython keeps no count of
+    allocations made, so the memory of a stage is measured by the peak bytes
+    tracemalloc traced while it ran and the memory blocks it still held once
+    it returned, both per row.
+    """
+    cache.result_cache_dir = None
+    forget_parsed_data()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak_rss = peak_rss_bytes()
+
+    forget_parsed_data()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    function()
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # blocks the stage left allocated, such as caches and parse tables
+    blocks_held = sys.getallocatedblocks() - blocks
+
+    return {'rows': n_rows,
+            'seconds': seconds,
+            'rows_per_second': n_rows / seconds if seconds else None,
+            'peak_rss_bytes': peak_rss,
+            'peak_traced_bytes_per_row': traced_peak / n_rows if n_rows else None,
+            'blocks_held_after_per_row': blocks_held / n_rows if n_rows else None}
+
+
+def run_stage(raw_file, summary_file, city, sample_size, name):
+    stages = benchmark_stages(raw_file, summary_file, city, sample_size)
+    return measure_stage(*stages[name])
+
+
+# seconds a fresh interpreter may take to import the command line interface
+cold_start_budget = 0.2
+
+
+def measure_cold_start(module='bikeshare.cli', repeat=5):
+    """
+    Returns the best of repeat timings, in seconds, of a fresh interpreter
+    starting and importing module, which is what every run of the command
+    line pays before any work is done. The modules that import also loads
+    are listed, so a heavy import creeping onto the path shows up.
+    """
+    command = [sys.executable, '-c',
+               'import sys, {0}; print(" ".join(sorted(sys.modules)))'.format(module)]
+    # import this copy of the package, wherever the benchmark is run from
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        modules = subprocess.check_output(command, env=env).decode().split()
+        seconds.append(time.perf_counter() - start)
+    return {'seconds': min(seconds),
+            'budget': cold_start_budget,
+            'numpy': 'numpy' in modules,
+            'matplotlib': 'matplotlib' in modules}
+
+
+def run_benchmarks(out_file, n_rows=10**5, cities=('NYC', 'Chicago', 'Washington'),
+                   sample_size=10**5, work_dir=None, seed=2016):
+    """
+    Benchmarks every stage on a synthetic raw file of n_rows trips of each
+    city and saves the results to out_file as JSON. The helper functions are
+    timed on the first sample_size rows only. Peak RSS is that of the
+    process running the stage, which includes the interpreter itself.
+    Returns the results.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    results = {'commit': commit,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'n_rows': n_rows,
+               'cities': {}}
+
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory(dir=work_dir) as directory:
+        for city in cities:
+            raw_file = os.path.join(directory, '{}-raw.csv'.format(city))
+            summary_file = os.path.join(directory, '{}-summary.csv'.format(city))
+            write_synthetic_city(raw_file, city, n_rows, seed)
+            condense_data(raw_file, summary_file, city)
+
+            results['cities'][city] = {}
+            for name in benchmark_stages(raw_file, summary_file, city, 0):
+                # a fresh process for every stage, so peak RSS is its own
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    metrics = executor.submit(run_stage, raw_file, summary_file,
+                                              city, sample_size, name).result()
+                results['cities'][city][name] = metrics
+                print('{:<12}{:<20}{:>14,.0f} rows/s'.format(
+                    city, name, metrics['rows_per_second'] or 0))
+
+    results['cold_start'] = measure_cold_start()
+    print('cold start  {:.3f} s (budget {:.3f} s)'.format(
+        results['cold_start']['seconds'], cold_start_budget))
+
+    with open(out_file, 'w') as f_out:
+        json.dump(results, f_out, indent=2)
+    return results
+
+
+def compare_benchmarks(before_file, after_file, tolerance=0.1):
+    """
+    Prints the change in throughput of every stage between two saved
+    benchmark runs and returns the (city, stage) pairs that got slower by more
+    than tolerance.
+    """
+    with open(before_file) as f_in:
+        before = json.load(f_in)
+    with open(after_file) as f_in:
+        after = json.load(f_in)
+
+    regressions = []
+    for city, stages in after['cities'].items():
+        for name, metrics in stages.items():
+            old = before['cities'].get(city, {}).get(name)
+            if not old or not old['rows_per_second'] or not metrics['rows_per_second']:
+                continue
+            change = metrics['rows_per_second'] / old['rows_per_second'] - 1
+            print('{:<12}{:<20}{:>+8.1%}'.format(city, name, change))
+            if change < -tolerance:
+                regressions.append((city, name))
+
+    # the cold start is held to its budget rather than to the previous run
+    cold_start = after.get('cold_start')
+    if cold_start and cold_start['seconds'] > cold_start['budget']:
+        print('cold start  {:.3f} s over its budget of {:.3f} s'.format(
+            cold_start['seconds'], cold_start['budget']))
+        regressions.append((None, 'cold_start'))
+    return regressions
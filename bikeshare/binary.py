@@ -0,0 +1,91 @@
+"""
+Writing of binary summary files, the fixed-width record version of the
+condensed summary files.
+"""
+
+import json
+import os
+import struct
+
+from .cache import forget_cached_results
+
+
+binary_summary_magic = b'BIKESUM1'
+
+
+binary_summary_header = struct.Struct('<8sQQ')
+
+
+binary_summary_record = struct.Struct('<fBBBB')
+
+
+def open_binary_summary(filename):
+    """
+    Starts writing a binary summary file. Returns the state passed on to
+    add_binary_record and close_binary_summary. The file is written under a
+    temporary name and only replaces filename once it is complete, so readers
+    that have the old file mapped never see a partly written one.
+    """
+    f_out = open(filename + '.tmp', 'wb')
+    f_out.write(binary_summary_header.pack(binary_summary_magic, 0, 0))
+    return {'filename': filename, 'file': f_out, 'records': bytearray(),
+            'count': 0,
+            'day_names': ['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                          'Friday', 'Saturday', 'Sunday'],
+            'user_type_names': ['Subscriber', 'Customer']}
+
+
+def category_code(names, name):
+    if name not in names:
+        names.append(name)
+    return names.index(name)
+
+
+def add_binary_record(summary, point):
+    """
+    Appends one condensed data point, a dictionary with the keys of the
+    condensed csv file, to a binary summary file.
+    """
+    summary['records'] += binary_summary_record.pack(
+        point['duration'], point['month'], point['hour'],
+        category_code(summary['day_names'], point['day_of_week']),
+        category_code(summary['user_type_names'], point['user_type']))
+    summary['count'] += 1
+    if len(summary['records']) >= 2**20:
+        summary['file'].write(summary['records'])
+        summary['records'] = bytearray()
+
+
+def close_binary_summary(summary):
+    """
+    Writes the trailer and header of a binary summary file and moves it into
+    place.
+    """
+    f_out = summary['file']
+    f_out.write(summary['records'])
+    trailer_offset = f_out.tell()
+    f_out.write(json.dumps({'day_names': summary['day_names'],
+                            'user_type_names': summary['user_type_names']}).encode())
+    f_out.seek(0)
+    f_out.write(binary_summary_header.pack(binary_summary_magic,
+                                           summary['count'], trailer_offset))
+    f_out.close()
+    os.replace(summary['filename'] + '.tmp', summary['filename'])
+    forget_cached_results(summary['filename'])
+
+
+def abort_binary_summary(summary):
+    """
+    Closes a binary summary file that failed to be written and removes its
+    temporary file, leaving any earlier file in place.
+    """
+    summary['file'].close()
+    try:
+        os.remove(summary['filename'] + '.tmp')
+    except FileNotFoundError:
+        pass
+
+
+def is_binary_summary(filename):
+    with open(filename, 'rb') as f_in:
+        return f_in.read(len(binary_summary_magic)) == binary_summary_magic
@@ -0,0 +1,151 @@
+"""
+The on-disk cache of the results of the statistics functions, keyed by a
+hash of the content of the data file they read and of the source of the
+package that computed them. The cache is off unless result_cache_dir is set,
+as the command line interface does.
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+
+
+# directory of the result cache (None turns the cache off) and its size limit
+result_cache_dir = None
+
+
+# the directory the command line interface keeps results in
+default_result_cache_dir = './.result-cache'
+
+
+result_cache_max_bytes = 256 * 2**20
+
+
+# absolute path -> (size, mtime, content hash) of the files hashed so far
+file_hashes = {}
+
+
+def file_fingerprint(filename):
+    """
+    Returns a hash of the content of a file, only reading the file again if
+    its size or modification time has changed since it was last hashed.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    known = file_hashes.get(path)
+    if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f_in:
+            for block in iter(lambda: f_in.read(2**20), b''):
+                digest.update(block)
+        known = file_hashes[path] = (stat.st_size, stat.st_mtime_ns,
+                                     digest.hexdigest())
+    return known[2]
+
+
+# hash of the source of the package, computed once
+package_hash = None
+
+
+def package_fingerprint():
+    """
+    Returns a hash of the source of every module of the package, so results
+    computed by an earlier version of the code are never reused.
+    """
+    global package_hash
+    if package_hash is None:
+        digest = hashlib.sha256()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package_dir)):
+            if name.endswith('.py'):
+                digest.update(name.encode())
+                with open(os.path.join(package_dir, name), 'rb') as f_in:
+                    digest.update(f_in.read())
+        package_hash = digest.hexdigest()
+    return package_hash
+
+
+def cache_prefix(filename):
+    # every cached result of a file starts with the same prefix, so they can
+    # all be found again when the file is rewritten
+    return hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:16]
+
+
+def forget_cached_results(filename):
+    """
+    Drops the cached results of a data file, which is about to be or has just
+    been rewritten.
+    """
+    file_hashes.pop(os.path.abspath(filename), None)
+    if result_cache_dir is None or not os.path.isdir(result_cache_dir):
+        return
+    prefix = cache_prefix(filename) + '-'
+    for entry in os.listdir(result_cache_dir):
+        if entry.startswith(prefix):
+            try:
+                os.remove(os.path.join(result_cache_dir, entry))
+            except FileNotFoundError:
+                pass
+
+
+def evict_cached_results():
+    """
+    Removes the least recently used results until the cache fits in
+    result_cache_max_bytes.
+    """
+    entries = []
+    for entry in os.scandir(result_cache_dir):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for used, size, path in entries)
+    for used, size, path in sorted(entries):
+        if total <= result_cache_max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_result(function):
+    """
+    Decorates a function whose first argument is a data file so its results
+    are kept in the result cache.
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def cached(filename, *args, **kwargs):
+        if result_cache_dir is None:
+            return function(filename, *args, **kwargs)
+        # the same call gives the same key however its arguments are passed
+        arguments = signature.bind(filename, *args, **kwargs)
+        arguments.apply_defaults()
+        parameters = list(arguments.arguments.items())[1:]
+        key = repr((function.__module__, function.__qualname__, package_fingerprint(),
+                    file_fingerprint(filename), parameters))
+        path = os.path.join(result_cache_dir, '{}-{}.pickle'.format(
+            cache_prefix(filename), hashlib.sha256(key.encode()).hexdigest()))
+        try:
+            with open(path, 'rb') as f_in:
+                result = pickle.load(f_in)
+            # mark the result as recently used
+            os.utime(path)
+            return result
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+
+        result = function(filename, *args, **kwargs)
+        os.makedirs(result_cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f_out:
+            pickle.dump(result, f_out)
+        os.replace(path + '.tmp', path)
+        evict_cached_results()
+        return result
+    return cached
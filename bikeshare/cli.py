@@ -0,0 +1,193 @@
+"""
+The command line interface: computes the statistics of the analysis for
+summary files without a notebook, and condenses raw data files.
+
+    python -m bikeshare report data/NYC-2016-Summary.csv --charts charts/
+    python -m bikeshare condense raw.csv data/NYC-2016-Summary.csv --city NYC
+    python -m bikeshare serve data/NYC-2016-Summary.csv --port 8000
+
+Only the modules a command needs are imported, and matplotlib only when
+charts are asked for, so a report starts quickly.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from . import cache
+from .instrumentation import collect_metrics, save_metrics
+from .statistics import (duration_ridership, length_of_trip, monthly_trips,
+                         number_of_trips, summary_statistic)
+
+
+def file_city(filename):
+    """
+    Returns the city of a data file named like NYC-2016-Summary.csv.
+    """
+    return os.path.basename(filename).split('-')[0]
+
+
+def summary_report(filename):
+    """
+    Returns the statistics of a condensed data file as a dictionary.
+    """
+    n_subscribers, n_customers, n_total = number_of_trips(filename)
+    avg_length, trips_longer_30 = length_of_trip(filename)
+    _, _, sub_avg, cus_avg, _ = duration_ridership(filename)
+    sub_months, cus_months = monthly_trips(filename)
+    return {'city': file_city(filename),
+            'trips': {'Subscriber': n_subscribers, 'Customer': n_customers,
+                      'total': n_total},
+            'average_duration': avg_length,
+            'percent_longer_than_30': trips_longer_30,
+            'average_duration_by_user_type': {'Subscriber': sub_avg,
+                                              'Customer': cus_avg},
+            'monthly_trips': {'Subscriber': sub_months, 'Customer': cus_months}}
+
+
+def minutes(average):
+    # averages are None for a user type without any trip
+    return 'no trips' if average is None else '{} minutes'.format(average)
+
+
+def print_report(filename, report, f_out):
+    trips = report['trips']
+    print('{} ({})'.format(report['city'], filename), file=f_out)
+    print('  trips: {total} ({Subscriber} Subscribers, {Customer} Customers)'.format(
+        **trips), file=f_out)
+    if trips['total']:
+        print('  average duration: {}, {}% longer than 30 minutes'.format(
+            minutes(report['average_duration']), report['percent_longer_than_30']),
+            file=f_out)
+    averages = report['average_duration_by_user_type']
+    print('  average duration of Subscribers: {}, of Customers: {}'.format(
+        minutes(averages['Subscriber']), minutes(averages['Customer'])), file=f_out)
+    for user_type, months in report['monthly_trips'].items():
+        print('  {} trips per month: {}'.format(
+            user_type, ' '.join(str(trips) for trips in months)), file=f_out)
+    # rows that do not parse, such as a last row cut short, are left out
+    malformed_rows = summary_statistic(filename, 'malformed_rows')
+    if malformed_rows:
+        print('  skipped {} malformed rows'.format(malformed_rows), file=f_out)
+
+
+def run_report(args, f_out):
+    reports = {filename: summary_report(filename) for filename in args.files}
+    if args.json:
+        json.dump(reports, f_out, indent=2)
+        f_out.write('\n')
+    else:
+        for filename, report in reports.items():
+            print_report(filename, report, f_out)
+
+    if args.charts:
+        # matplotlib is only loaded here
+        from .plots import save_charts
+        save_charts({report['city']: filename for filename, report in reports.items()},
+                    args.charts, args.chart_format, args.chart_workers)
+
+
+def run_condense(args, f_out):
+    from .condense import condense_data, quarantine_path
+    problems = condense_data(args.in_file, args.out_file, args.city,
+                             binary_file=args.binary, cube_file=args.cube,
+                             index=args.index, database=args.database)
+    if problems:
+        print('quarantined {} rows to {}: {}'.format(
+            sum(problems.values()), quarantine_path(args.out_file),
+            ', '.join('{} {}'.format(n, reason) for reason, n in sorted(problems.items()))),
+            file=f_out)
+
+
+def run_serve(args, f_out):
+    # numpy is only loaded by the service
+    from .service import start_service, stop_service
+    address = args.socket or (args.host, args.port)
+    service = start_service({file_city(filename): filename for filename in args.files},
+                            address, args.workers, args.reload_interval)
+    print('serving {} on {}'.format(
+        ', '.join(service['cities']),
+        service['address'] if args.socket else 'http://{}:{}'.format(*service['address'])),
+        file=f_out, flush=True)
+    try:
+        service['stop'].wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_service(service)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='bikeshare', description='Bike share trip statistics.')
+    parser.add_argument('--cache-dir', default=cache.default_result_cache_dir,
+                        help='directory of the result cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='compute every result from the data files')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='save the metrics of the run to FILE as JSON')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    report = commands.add_parser('report', help='print the statistics of '
+                                 'condensed summary files')
+    report.add_argument('files', nargs='+', metavar='SUMMARY_FILE')
+    report.add_argument('--json', action='store_true', help='print JSON')
+    report.add_argument('--charts', metavar='DIRECTORY',
+                        help='also save the charts of each file to DIRECTORY')
+    report.add_argument('--chart-format', nargs='+', default=['png'],
+                        choices=['png', 'svg', 'jpg'],
+                        help='formats to save the charts in')
+    report.add_argument('--chart-workers', type=int,
+                        help='processes drawing the charts (default: one per CPU)')
+    report.set_defaults(run=run_report)
+
+    condense = commands.add_parser('condense', help='condense a raw data file '
+                                   'into a summary file')
+    condense.add_argument('in_file')
+    condense.add_argument('out_file')
+    condense.add_argument('--city', required=True)
+    condense.add_argument('--binary', metavar='FILE',
+                          help='also write a binary summary to FILE')
+    condense.add_argument('--cube', metavar='FILE',
+                          help='also save a trip cube to FILE')
+    condense.add_argument('--index', action='store_true',
+                          help='also save a block index next to the summary')
+    condense.add_argument('--database', metavar='FILE',
+                          help='also load the trips into the SQLite database FILE')
+    condense.set_defaults(run=run_condense)
+
+    serve = commands.add_parser('serve', help='serve the statistics of condensed '
+                                'summary files as JSON over HTTP')
+    serve.add_argument('files', nargs='+', metavar='SUMMARY_FILE')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--socket', metavar='PATH',
+                       help='listen on a Unix socket instead of a port')
+    serve.add_argument('--workers', type=int, default=8,
+                       help='threads handling requests')
+    serve.add_argument('--reload-interval', type=float, default=1.0,
+                       help='seconds between checks of the files for changes')
+    serve.set_defaults(run=run_serve)
+    return parser
+
+
+def main(argv=None, f_out=None):
+    """
+    Runs the command line interface on argv (by default sys.argv[1:]) and
+    returns the exit status.
+    """
+    args = build_parser().parse_args(argv)
+    f_out = f_out or sys.stdout
+    cache.result_cache_dir = None if args.no_cache else args.cache_dir
+    try:
+        if args.metrics:
+            with collect_metrics() as metrics:
+                args.run(args, f_out)
+            save_metrics(metrics, args.metrics)
+        else:
+            args.run(args, f_out)
+    except (OSError, ValueError, KeyError) as error:
+        print('bikeshare: error: {}'.format(error), file=sys.stderr)
+        return 1
+    return 0
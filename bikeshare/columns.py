@@ -0,0 +1,316 @@
+"""
+Loading of summary files into numpy columns, cached on disk, and the
+vectorized versions of the statistics functions.
+"""
+
+import csv
+import itertools
+import json
+import os
+
+import numpy as np
+
+from .adapters import (adapter_columns, city_adapters, compile_city_adapter,
+                       compile_row_problem, condense_rows, parse_summary_rows,
+                       start_time_parser, summary_user_type, user_type_mapper)
+from .binary import (binary_summary_header, binary_summary_magic,
+                     is_binary_summary)
+from .cache import forget_cached_results
+from .files import open_data_file
+from .instrumentation import count_rows
+
+
+day_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+             'Saturday', 'Sunday']
+
+
+user_type_names = ['Subscriber', 'Customer']
+
+
+# dtype of the rows of a condensed summary file
+summary_dtype = [('duration', np.float32), ('month', np.uint8),
+                 ('hour', np.uint8), ('day_of_week', 'U16'),
+                 ('user_type', 'U16')]
+
+
+def categorical_codes(values, categories):
+    """
+    Returns the uint8 codes of values in categories, appending any value that
+    is not there yet to the end of the categories list.
+    """
+    values = np.asarray(values)
+    codes = np.zeros(len(values), dtype=np.uint8)
+    unmatched = np.ones(len(values), dtype=bool)
+    for code, name in enumerate(list(categories)):
+        match = values == name
+        codes[match] = code
+        unmatched &= ~match
+    if unmatched.any():
+        for value in np.unique(values[unmatched]).tolist():
+            codes[values == value] = len(categories)
+            categories.append(value)
+    return codes
+
+
+def summary_user_type_codes(codes, names, user_types):
+    """
+    Returns codes into names, the user types as found in a summary file, as
+    codes into user_types of the user types they stand for (see
+    adapters.summary_user_types), extending user_types as categorical_codes
+    does.
+    """
+    lookup = []
+    for name in names:
+        user_type = summary_user_type(name)
+        if user_type not in user_types:
+            user_types.append(user_type)
+        lookup.append(user_types.index(user_type))
+    if lookup == list(range(len(names))):
+        return codes
+    return np.array(lookup, dtype=np.uint8)[codes]
+
+
+def iter_trip_blocks(filename, city=None, block_rows=65536, days=None,
+                     user_types=None, duration_dtype=np.float32):
+    """
+    Yields the trips of a condensed summary file (when city is None) or of the
+    raw data file of a city block_rows at a time, as dictionaries of NumPy
+    columns: 'duration' in minutes (of duration_dtype), 'month' and 'hour'
+    (uint8), and 'day_of_week' and 'user_type' as uint8 codes into the days
+    and user_types lists, which are extended with any new name found. The
+    rows of a raw file that condense_data would quarantine are left out, and
+    the user types of a summary file are read as the user types they stand
+    for, such as Subscriber for Registered, leaving out malformed rows.
+    """
+    if days is None:
+        days = list(day_names)
+    if user_types is None:
+        user_types = list(user_type_names)
+
+    with open_data_file(filename) as f_in:
+        header = next(csv.reader([f_in.readline()]))
+        if city is None:
+            # summary files hold plain, unquoted values, so NumPy's own text
+            # parser can convert a block of lines straight into typed fields
+            dtype = [(name, duration_dtype if name == 'duration' else kind)
+                     for name, kind in summary_dtype]
+            columns = [header.index(name) for name, kind in summary_dtype]
+            while True:
+                lines = list(itertools.islice(f_in, block_rows))
+                if not lines:
+                    break
+                try:
+                    block = np.loadtxt(lines, delimiter=',', dtype=dtype,
+                                       usecols=columns, ndmin=1)
+                    found = []
+                    user_type = summary_user_type_codes(
+                        categorical_codes(block['user_type'], found), found, user_types)
+                except (ValueError, IndexError):
+                    # leave out the malformed rows scan_summary counts, such as
+                    # a last row cut short
+                    block = np.array(parse_summary_rows(csv.reader(lines), columns, []),
+                                     dtype=dtype)
+                    user_type = categorical_codes(block['user_type'], user_types)
+                count_rows(len(block))
+                yield {'duration': block['duration'],
+                       'month': block['month'],
+                       'hour': block['hour'],
+                       'day_of_week': categorical_codes(block['day_of_week'], days),
+                       'user_type': user_type}
+        else:
+            adapter = city_adapters[city]
+            columns = adapter_columns(adapter, header)
+            divisor = adapter['divisor']
+            parse_times = start_time_parser(adapter)
+            map_user_type = user_type_mapper(adapter)
+            transform = compile_city_adapter(city, header)
+            problem = compile_row_problem(city, header)
+            reader = csv.reader(f_in)
+            while True:
+                rows = list(itertools.islice(reader, block_rows))
+                if not rows:
+                    break
+                count_rows(len(rows))
+                try:
+                    durations = np.array([float(row[columns[0]]) for row in rows]) / divisor
+                    if not np.all((durations >= 0) & (durations < np.inf)):
+                        raise ValueError('duration out of range')
+                    month, hour, day_of_week = parse_times(
+                        [row[columns[1]] for row in rows])
+                    user_values = [map_user_type(row[columns[2]]) for row in rows]
+                except (ValueError, KeyError, IndexError):
+                    # leave out the rows condense_data would quarantine
+                    trips = condense_rows(transform, problem, rows, [])
+                    durations, month, hour, day_of_week, user_values = (
+                        [list(column) for column in zip(*trips)] or [[]] * 5)
+                    durations = np.array(durations, dtype=np.float64)
+                yield {'duration': durations.astype(duration_dtype),
+                       'month': np.array(month, dtype=np.uint8),
+                       'hour': np.array(hour, dtype=np.uint8),
+                       'day_of_week': categorical_codes(day_of_week, days),
+                       'user_type': categorical_codes(user_values, user_types)}
+
+
+def load_trip_columns(filename, city=None, block_rows=65536):
+    """
+    Reads a condensed summary file (when city is None) or the raw data file of
+    a city into a dictionary of NumPy columns: 'duration' in minutes
+    (float32), 'month' and 'hour' (uint8), and 'day_of_week' and 'user_type'
+    as uint8 codes into the 'day_names' and 'user_type_names' lists also
+    returned. The file is converted block_rows rows at a time, so no more than
+    one block of rows is held as Python strings at any point.
+    """
+    days = list(day_names)
+    user_types = list(user_type_names)
+    blocks = {'duration': [], 'month': [], 'hour': [], 'day_of_week': [],
+              'user_type': []}
+    for block in iter_trip_blocks(filename, city, block_rows, days, user_types):
+        for name, column in block.items():
+            blocks[name].append(column)
+
+    dtypes = {'duration': np.float32, 'month': np.uint8, 'hour': np.uint8,
+              'day_of_week': np.uint8, 'user_type': np.uint8}
+    trips = {name: np.concatenate(parts) if parts else np.zeros(0, dtypes[name])
+             for name, parts in blocks.items()}
+    trips['day_names'] = days
+    trips['user_type_names'] = user_types
+    return trips
+
+
+# filename -> ((size, mtime), columns) for the summary files loaded so far
+column_loads = {}
+
+
+def summary_columns(filename):
+    """
+    Returns the columns of a condensed data file, csv or binary summary, only
+    reading the file again if it has changed since it was last loaded.
+    """
+    stat = os.stat(filename)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    cached = column_loads.get(filename)
+    if cached is None or cached[0] != stamp:
+        if is_binary_summary(filename):
+            columns = read_binary_summary(filename)
+        else:
+            columns = load_trip_columns(filename)
+        cached = column_loads[filename] = (stamp, columns)
+    return cached[1]
+
+
+binary_summary_dtype = np.dtype([('duration', '<f4'), ('month', 'u1'),
+                                 ('hour', 'u1'), ('day_of_week', 'u1'),
+                                 ('user_type', 'u1')])
+
+
+def read_binary_summary(filename):
+    """
+    Maps a binary summary file into memory and returns the same dictionary of
+    columns as load_trip_columns, as views into the mapped records.
+    """
+    with open(filename, 'rb') as f_in:
+        magic, count, trailer_offset = binary_summary_header.unpack(
+            f_in.read(binary_summary_header.size))
+        f_in.seek(trailer_offset)
+        trailer = json.loads(f_in.read().decode())
+
+    trips = {}
+    if count:
+        records = np.memmap(filename, dtype=binary_summary_dtype, mode='r',
+                            offset=binary_summary_header.size, shape=(count,))
+    else:
+        records = np.zeros(0, dtype=binary_summary_dtype)
+    for name in binary_summary_dtype.names:
+        trips[name] = records[name]
+    trips['day_names'] = trailer['day_names']
+    user_types = []
+    trips['user_type'] = summary_user_type_codes(trips['user_type'],
+                                                 trailer['user_type_names'], user_types)
+    trips['user_type_names'] = user_types
+    return trips
+
+
+def write_binary_summary(csv_file, binary_file):
+    """
+    Converts an existing condensed csv file into a binary summary file.
+    """
+    trips = load_trip_columns(csv_file)
+    records = np.zeros(len(trips['duration']), dtype=binary_summary_dtype)
+    for name in binary_summary_dtype.names:
+        records[name] = trips[name]
+
+    with open(binary_file + '.tmp', 'wb') as f_out:
+        trailer_offset = binary_summary_header.size + records.nbytes
+        f_out.write(binary_summary_header.pack(binary_summary_magic,
+                                               len(records), trailer_offset))
+        f_out.write(records.tobytes())
+        f_out.write(json.dumps({'day_names': trips['day_names'],
+                                'user_type_names': trips['user_type_names']}).encode())
+    os.replace(binary_file + '.tmp', binary_file)
+    forget_cached_results(binary_file)
+
+
+def user_type_mask(trips, user_type):
+    names = trips['user_type_names']
+    if user_type not in names:
+        return np.zeros(len(trips['user_type']), dtype=bool)
+    return trips['user_type'] == names.index(user_type)
+
+
+def number_of_trips_vectorized(filename):
+    trips = summary_columns(filename)
+    n_total = len(trips['duration'])
+    n_subscribers = int(np.count_nonzero(user_type_mask(trips, 'Subscriber')))
+    n_customers = n_total - n_subscribers
+    return (n_subscribers, n_customers, n_total)
+
+
+def length_of_trip_vectorized(filename):
+    duration = summary_columns(filename)['duration']
+    if not len(duration):
+        return (None, None)
+    avg_length = round(float(duration.sum(dtype=np.float64)) / len(duration), 1)
+    trips_longer_30 = round(float(np.count_nonzero(duration > 30) / len(duration))*100, 1)
+    return (avg_length, trips_longer_30)
+
+
+def duration_ridership_vectorized(filename):
+    trips = summary_columns(filename)
+    duration = trips['duration']
+    is_customer = user_type_mask(trips, 'Customer')
+    customers = int(np.count_nonzero(is_customer))
+    subscibers = len(duration) - customers
+    cus_length = float(duration[is_customer].sum(dtype=np.float64))
+    sub_length = float(duration[~is_customer].sum(dtype=np.float64))
+    sub_avg = round(sub_length / subscibers, 1) if subscibers else None
+    cus_avg = round(cus_length / customers, 1) if customers else None
+    return (subscibers, customers, sub_avg, cus_avg, subscibers + customers)
+
+
+def visualize_trip_time_vectorized(filename):
+    return summary_columns(filename)['duration']
+
+
+def duration_of_sub_users_vectorized(filename):
+    trips = summary_columns(filename)
+    duration = trips['duration']
+    return duration[user_type_mask(trips, 'Subscriber') & (duration < 75)]
+
+
+def duration_of_cus_users_vectorized(filename):
+    trips = summary_columns(filename)
+    duration = trips['duration']
+    return duration[user_type_mask(trips, 'Customer') & (duration < 75)]
+
+
+def monthly_trips_vectorized(filename):
+    """
+    Returns the number of Subscriber and Customer trips in each month, as two
+    arrays of length 12, the counts plotted by total_customers_and_subscribers.
+    """
+    trips = summary_columns(filename)
+    is_customer = user_type_mask(trips, 'Customer')
+    month = trips['month']
+    sub_info = np.bincount(month[~is_customer], minlength=13)[1:13]
+    cus_info = np.bincount(month[is_customer], minlength=13)[1:13]
+    return (sub_info, cus_info)
@@ -0,0 +1,536 @@
+"""
+Condensing of the raw data files of a city into summary files, serially,
+in parallel, pipelined on threads or incrementally.
+"""
+
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import instrumentation
+from .adapters import compile_city_adapter, compile_row_problem, condense_rows
+from .binary import (abort_binary_summary, add_binary_record,
+                     close_binary_summary, open_binary_summary)
+from .cache import forget_cached_results
+from .database import (abort_database_load, add_database_rows, close_database_load,
+                       open_database_load)
+from .files import (file_compression, is_quote_wrapped_line, open_data_file,
+                    read_text_blocks, unwrap_lines)
+from .index import add_index_block, new_index, save_index
+from .instrumentation import add_stage_time, count_rows, instrumented
+from .statistics import summary_statistics
+
+
+def quarantine_path(filename):
+    """
+    Returns the name of the file holding the rows of raw files that were
+    left out of a summary file.
+    """
+    return filename + '.quarantine.csv'
+
+
+def running_state_path(filename):
+    """
+    Returns the name of the file holding the running state that
+    condense_data_incremental keeps for a condensed data file.
+    """
+    return filename + '.state.json'
+
+
+def forget_running_state(filename):
+    """
+    Drops the running state of a condensed data file that is about to be
+    written from scratch, which would no longer describe it.
+    """
+    try:
+        os.remove(running_state_path(filename))
+    except FileNotFoundError:
+        pass
+
+
+def open_quarantine(filename, header, append=False):
+    """
+    Returns a quarantine file for the rejected rows of a raw file with the
+    given header. The file is only created once a row is added to it.
+    """
+    return {'filename': filename, 'header': header, 'append': append,
+            'f_out': None, 'writer': None, 'counts': {}}
+
+
+def add_quarantined(quarantine, quarantined):
+    """
+    Adds rejected rows, as [reason] + row, to a quarantine file.
+    """
+    if not quarantined:
+        return
+    if quarantine['f_out'] is None:
+        exists = quarantine['append'] and os.path.exists(quarantine['filename'])
+        quarantine['f_out'] = open(quarantine['filename'], 'a' if exists else 'w',
+                                   newline='')
+        quarantine['writer'] = csv.writer(quarantine['f_out'])
+        if not exists:
+            quarantine['writer'].writerow(['reason'] + quarantine['header'])
+    quarantine['writer'].writerows(quarantined)
+    counts = quarantine['counts']
+    for row in quarantined:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+
+
+def close_quarantine(quarantine):
+    """
+    Closes a quarantine file and returns the number of rows rejected for
+    each reason. A quarantine file left by an earlier run of a file that
+    now has no rejected rows is removed.
+    """
+    if quarantine['f_out'] is not None:
+        quarantine['f_out'].close()
+    elif not quarantine['append'] and os.path.exists(quarantine['filename']):
+        os.remove(quarantine['filename'])
+    return quarantine['counts']
+
+
+def abort_quarantine(quarantine):
+    """
+    Closes a quarantine file when condensing fails, leaving the rows added
+    so far and any file of an earlier run in place.
+    """
+    if quarantine['f_out'] is not None:
+        quarantine['f_out'].close()
+
+
+@instrumented(reads=('in_file',), writes=('out_file', 'binary_file', 'cube_file'))
+def condense_data(in_file, out_file, city, binary_file=None, cube_file=None,
+                  index=False, database=None):
+    """
+    This function takes full data from the specified input file
+    and writes the condensed data to a specified output file. The city
+    argument determines how the input file will be parsed. If binary_file is
+    given, the condensed data is also written there as a binary summary, and
+    if cube_file is given, a trip cube of the data is saved there. With
+    index, a block index of the output file is saved next to it. If database
+    is given, the trips of the city in that trip database are replaced with
+    the condensed data, committed once the whole file is condensed.
+
+    Rows that are not valid trips (see adapters.row_problems) are left out
+    of the output file and written with the code of their problem to
+    quarantine_path(out_file). Returns the number of rows left out for each
+    reason.
+    """
+    if index and file_compression(out_file):
+        raise ValueError('a compressed file cannot be read from an offset, '
+                         'so {} cannot be indexed'.format(out_file))
+    forget_running_state(out_file)
+
+    # written under a temporary name, so a failed run leaves an earlier
+    # summary in place
+    try:
+        with open_data_file(in_file, 'r') as f_in, \
+                open_data_file(out_file + '.tmp', 'w', file_compression(out_file)) as f_out:
+            # set up csv DictWriter object - writer requires column names for the
+            # first row as the "fieldnames" argument
+            out_colnames = ['duration', 'month', 'hour', 'day_of_week', 'user_type']
+            trip_writer = csv.DictWriter(f_out, fieldnames = out_colnames)
+            trip_writer.writeheader()
+            binary_summary = cube = quarantine = database_load = None
+            try:
+                binary_summary = open_binary_summary(binary_file) if binary_file else None
+                if cube_file:
+                    # numpy is only loaded when a cube is asked for
+                    from .cube import add_to_cube, close_cube, open_cube
+                    cube = open_cube(cube_file)
+
+                # read plain rows and condense them with the adapter of the city,
+                # which takes each value from its position in the row
+                trip_reader = csv.reader(f_in)
+                header = next(trip_reader)
+                transform = compile_city_adapter(city, header)
+                problem = compile_row_problem(city, header)
+                quarantine = open_quarantine(quarantine_path(out_file), header)
+                row_writer = csv.writer(f_out)
+                database_load = open_database_load(database, city) if database else None
+                if index:
+                    block_index = new_index(out_colnames)
+                    block_start = f_out.tell()
+
+                # collect data from and process the rows a block at a time, timing
+                # the reading, condensing and writing of each block
+                while True:
+                    start = time.perf_counter()
+                    rows = list(itertools.islice(trip_reader, 4096))
+                    if not rows:
+                        break
+                    read = time.perf_counter()
+                    quarantined = []
+                    block = condense_rows(transform, problem, rows, quarantined)
+                    add_quarantined(quarantine, quarantined)
+                    condensed = time.perf_counter()
+
+                    row_writer.writerows(block)
+                    if index and block:
+                        # in write mode, tell() is the byte offset in the file
+                        block_end = f_out.tell()
+                        add_index_block(block_index, block_start, block_end, block)
+                        block_start = block_end
+                    if database_load:
+                        add_database_rows(database_load, block)
+                    if binary_summary or cube:
+                        for values in block:
+                            new_point = dict(zip(out_colnames, values))
+                            if binary_summary:
+                                add_binary_record(binary_summary, new_point)
+                            if cube:
+                                add_to_cube(cube, new_point)
+                    if instrumentation.metric_stack:
+                        add_stage_time('read', read - start)
+                        add_stage_time('condense', condensed - read)
+                        add_stage_time('write', time.perf_counter() - condensed)
+                        count_rows(len(block))
+
+                if binary_summary:
+                    close_binary_summary(binary_summary)
+                if cube:
+                    close_cube(cube)
+                if database_load:
+                    close_database_load(database_load)
+            except BaseException:
+                # leave no open transaction, temporary file or handle behind
+                if binary_summary:
+                    abort_binary_summary(binary_summary)
+                if quarantine:
+                    abort_quarantine(quarantine)
+                if database_load:
+                    abort_database_load(database_load)
+                raise
+    except BaseException:
+        try:
+            os.remove(out_file + '.tmp')
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(out_file + '.tmp', out_file)
+
+    if index:
+        save_index(block_index, out_file)
+    forget_cached_results(out_file)
+    return close_quarantine(quarantine)
+
+
+def line_chunks(filename, chunk_bytes):
+    """
+    Returns the (start, end) byte ranges of the rows after the header of a
+    file, about chunk_bytes long each and always ending at a line boundary.
+    A compressed file cannot be read from an offset, so it is a single
+    (None, None) chunk.
+    """
+    if file_compression(filename):
+        return [(None, None)]
+    size = os.path.getsize(filename)
+    chunks = []
+    with open(filename, 'rb') as f_in:
+        f_in.readline()
+        start = f_in.tell()
+        while start < size:
+            f_in.seek(min(start + chunk_bytes, size))
+            f_in.readline()
+            end = min(f_in.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def condense_chunk(in_file, city, start, end):
+    """
+    Condenses the rows between byte offsets start and end of a raw city file
+    and returns them as the text condense_data would write for them, along
+    with the rows left out as [reason] + row. With start and end None, the
+    whole file is condensed.
+    """
+    with open_data_file(in_file, 'rb') as f_in:
+        header_line = f_in.readline()
+        if start is None:
+            data = f_in.read()
+        else:
+            f_in.seek(start)
+            data = f_in.read(end - start)
+    if is_quote_wrapped_line(header_line):
+        # the chunk starts and ends at line boundaries, so it unwraps on its own
+        header_line, data = unwrap_lines(header_line), unwrap_lines(data)
+
+    # decode the chunk the same way open() decodes the whole file
+    trip_reader = csv.reader(io.TextIOWrapper(io.BytesIO(header_line + data)))
+    header = next(trip_reader)
+    quarantined = []
+    block = condense_rows(compile_city_adapter(city, header),
+                          compile_row_problem(city, header), list(trip_reader),
+                          quarantined)
+    f_out = io.StringIO(newline='')
+    csv.writer(f_out).writerows(block)
+    return f_out.getvalue(), quarantined
+
+
+@instrumented(reads=(), writes=())
+def condense_data_parallel(city_info, workers=None, chunk_bytes=32 * 2**20):
+    """
+    Writes the condensed data file of every city in city_info, a dictionary
+    {city: {'in_file': ..., 'out_file': ...}}, using a pool of workers
+    processes (by default one per CPU). Raw files are split into chunks of
+    about chunk_bytes, condensed concurrently and written in order; about
+    two chunks per worker are pending at a time, so memory stays bounded
+    however large the files are. Rows that are not valid trips are
+    quarantined as by condense_data. Returns the number of rows left out
+    for each reason, for every city.
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = ((city, start, end) for city, filenames in city_info.items()
+             for start, end in line_chunks(filenames['in_file'], chunk_bytes))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # (city, future) of the chunks submitted and not yet written, in the
+        # order of the tasks
+        pending = collections.deque()
+
+        def submit_next():
+            task = next(tasks, None)
+            if task is not None:
+                city, start, end = task
+                pending.append((city, executor.submit(
+                    condense_chunk, city_info[city]['in_file'], city, start, end)))
+
+        for _ in range(2 * workers):
+            submit_next()
+
+        problems = {}
+        for city in city_info:
+            out_file = city_info[city]['out_file']
+            with open_data_file(city_info[city]['in_file']) as f_in:
+                header = next(csv.reader(f_in))
+            quarantine = open_quarantine(quarantine_path(out_file), header)
+            forget_running_state(out_file)
+            with open_data_file(out_file, 'w') as f_out:
+                out_colnames = ['duration', 'month', 'hour', 'day_of_week', 'user_type']
+                csv.DictWriter(f_out, fieldnames = out_colnames).writeheader()
+                # tasks are submitted in city order, so the city is done when
+                # the oldest pending chunk belongs to the next one
+                while pending and pending[0][0] == city:
+                    text, quarantined = pending.popleft()[1].result()
+                    submit_next()
+                    f_out.write(text)
+                    add_quarantined(quarantine, quarantined)
+                    if instrumentation.metric_stack:
+                        count_rows(text.count('\n'))
+            forget_cached_results(out_file)
+            problems[city] = close_quarantine(quarantine)
+    return problems
+
+
+@instrumented(reads=('in_file',), writes=('out_file',))
+def condense_data_pipelined(in_file, out_file, city, block_bytes=2**20,
+                            queue_blocks=4, decompress_workers=None):
+    """
+    Writes the condensed data file of a raw city file as condense_data does,
+    with reading, condensing and writing overlapped on threads. The raw file
+    is read in blocks of about block_bytes characters, and a multi-member
+    gzip file is decompressed by decompress_workers threads if given. Rows
+    that are not valid trips are quarantined as by condense_data, and the
+    number of rows left out for each reason is returned.
+    """
+    raw_blocks = queue.Queue(queue_blocks)
+    row_blocks = queue.Queue(queue_blocks)
+    # set when a stage fails, so the others stop waiting on the queues
+    stop = threading.Event()
+    errors = []
+
+    def put(blocks, block):
+        while not stop.is_set():
+            try:
+                blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(blocks):
+        # None marks the end of the blocks, or that a stage failed
+        while not stop.is_set():
+            try:
+                return blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def read():
+        for block in read_text_blocks(in_file, block_bytes, decompress_workers):
+            put(raw_blocks, block)
+            if stop.is_set():
+                break
+        put(raw_blocks, None)
+
+    def condense():
+        transform = None
+        while True:
+            block = get(raw_blocks)
+            if block is None:
+                break
+            trip_reader = csv.reader(io.StringIO(block))
+            if transform is None:
+                header = next(trip_reader)
+                transform = compile_city_adapter(city, header)
+                problem = compile_row_problem(city, header)
+                put(row_blocks, header)
+            quarantined = []
+            put(row_blocks, (condense_rows(transform, problem, list(trip_reader),
+                                           quarantined), quarantined))
+        put(row_blocks, None)
+
+    def stage(function):
+        try:
+            function()
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    threads = [threading.Thread(target=stage, args=(function,), daemon=True)
+               for function in [read, condense]]
+    for thread in threads:
+        thread.start()
+    quarantine = None
+    try:
+        with open_data_file(out_file + '.tmp', 'w', file_compression(out_file),
+                            buffering=2**20) as f_out:
+            out_colnames = ['duration', 'month', 'hour', 'day_of_week', 'user_type']
+            csv.DictWriter(f_out, fieldnames = out_colnames).writeheader()
+            trip_writer = csv.writer(f_out)
+            # the header of the raw file comes first
+            header = get(row_blocks)
+            quarantine = open_quarantine(quarantine_path(out_file), header or [])
+            while header is not None:
+                block = get(row_blocks)
+                if block is None:
+                    break
+                rows, quarantined = block
+                trip_writer.writerows(rows)
+                add_quarantined(quarantine, quarantined)
+                count_rows(len(rows))
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+    except BaseException:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # the summary and the quarantine file of an earlier run stay in place
+        if quarantine is not None:
+            abort_quarantine(quarantine)
+        try:
+            os.remove(out_file + '.tmp')
+        except FileNotFoundError:
+            pass
+        raise
+    problems = close_quarantine(quarantine)
+    forget_running_state(out_file)
+    os.replace(out_file + '.tmp', out_file)
+    forget_cached_results(out_file)
+    return problems
+
+
+# statistics kept up to date by condense_data_incremental
+running_statistics = ['user_types', 'trip_length', 'months', 'duration_moments',
+                      'duration_sketches']
+
+
+@instrumented(reads=('in_file',), writes=('out_file',))
+def condense_data_incremental(in_file, out_file, city):
+    """
+    Appends the trips of a raw city file that have not been condensed yet to
+    the condensed data file out_file and updates its running aggregates.
+    Returns the number of trips added.
+
+    How far each raw file has been condensed is saved with the aggregates in
+    out_file + '.state.json', so the same raw file can be passed again after
+    it has grown, as can any new daily file. Only complete lines are
+    condensed; a last line without a line break is left for the next call.
+    Without a state file, out_file is written from scratch. Rows that are
+    not valid trips are appended to quarantine_path(out_file).
+    """
+    state_file = running_state_path(out_file)
+    if os.path.exists(state_file):
+        with open(state_file) as f_in:
+            state = json.load(f_in)
+        stat = os.stat(out_file)
+        appending = state.pop('appending', None)
+        if [stat.st_size, stat.st_mtime_ns] != state.get('summary'):
+            if appending is None or stat.st_size < appending:
+                raise ValueError('{} has changed since it was last condensed '
+                                 'incrementally; remove {} to condense it from '
+                                 'scratch'.format(out_file, state_file))
+            # drop the rows appended by a run that stopped before saving its
+            # state
+            with open(out_file, 'r+b') as f_out:
+                f_out.truncate(appending)
+    else:
+        state = {'offsets': {},
+                 'aggregates': {name: summary_statistics[name][0]()
+                                for name in running_statistics}}
+        with open(out_file, 'w') as f_out:
+            out_colnames = ['duration', 'month', 'hour', 'day_of_week', 'user_type']
+            csv.DictWriter(f_out, fieldnames = out_colnames).writeheader()
+
+    key = os.path.abspath(in_file)
+    with open(in_file, 'rb') as f_in:
+        header_line = f_in.readline()
+        start = state['offsets'].get(key, f_in.tell())
+        if os.path.getsize(in_file) < start:
+            raise ValueError('{} is shorter than when it was last '
+                             'condensed'.format(in_file))
+        f_in.seek(start)
+        data = f_in.read()
+    data = data[:data.rfind(b'\n') + 1]
+    end = start + len(data)
+    if is_quote_wrapped_line(header_line):
+        # offsets are kept in the wrapped file, whose lines unwrap one by one
+        header_line, data = unwrap_lines(header_line), unwrap_lines(data)
+
+    # statistics added since the state was first saved are left to scans
+    updates = [(summary_statistics[name][1], state['aggregates'][name])
+               for name in running_statistics if name in state['aggregates']]
+    n_trips = 0
+    trip_reader = csv.reader(io.TextIOWrapper(io.BytesIO(header_line + data)))
+    header = next(trip_reader)
+    quarantined = []
+    block = condense_rows(compile_city_adapter(city, header),
+                          compile_row_problem(city, header), list(trip_reader),
+                          quarantined)
+    quarantine = open_quarantine(quarantine_path(out_file), header, append=True)
+    add_quarantined(quarantine, quarantined)
+    close_quarantine(quarantine)
+
+    # until the new state is saved, the summary may hold rows past this size
+    save_running_state(dict(state, appending=os.path.getsize(out_file)), state_file)
+    with open(out_file, 'a') as f_out:
+        trip_writer = csv.writer(f_out)
+        for duration, month, hour, day_of_week, user_type in block:
+            trip_writer.writerow((duration, month, hour, day_of_week, user_type))
+            for update, aggregate in updates:
+                update(aggregate, duration, str(month), str(hour), day_of_week,
+                       user_type)
+            n_trips += 1
+    count_rows(n_trips)
+
+    stat = os.stat(out_file)
+    state['summary'] = [stat.st_size, stat.st_mtime_ns]
+    state['offsets'][key] = end
+    save_running_state(state, state_file)
+    forget_cached_results(out_file)
+    return n_trips
+
+
+def save_running_state(state, state_file):
+    with open(state_file + '.tmp', 'w') as f_out:
+        json.dump(state, f_out)
+    os.replace(state_file + '.tmp', state_file)
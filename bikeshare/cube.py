@@ -0,0 +1,157 @@
+"""
+The trip cube: counts and total durations of the trips for every month,
+hour, day of the week and user type, and queries over it.
+"""
+
+import os
+
+import numpy as np
+
+from .binary import is_binary_summary
+from .cache import forget_cached_results
+from .columns import (day_names, iter_trip_blocks, read_binary_summary,
+                      user_type_names)
+
+
+# dimensions of the trip cube, in the order of its axes, and their values
+cube_dimensions = [('month', list(range(1, 13))),
+                   ('hour', list(range(24))),
+                   ('day_of_week', ['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                                    'Friday', 'Saturday', 'Sunday']),
+                   ('user_type', ['Subscriber', 'Customer'])]
+
+
+cube_shape = tuple(len(values) for name, values in cube_dimensions)
+
+
+cube_measures = ['count', 'duration', 'long_trips']
+
+
+def open_cube(filename):
+    """
+    Starts counting condensed data points into a trip cube to be saved as
+    filename. Returns the state passed on to add_to_cube and close_cube.
+    """
+    size = int(np.prod(cube_shape))
+    # flat Python lists while counting, which are quicker to update one
+    # point at a time than arrays
+    return {'filename': filename, 'count': [0] * size, 'duration': [0.0] * size,
+            'long_trips': [0] * size, 'skipped': 0,
+            'index': [{value: i for i, value in enumerate(values)}
+                      for name, values in cube_dimensions]}
+
+
+def add_to_cube(cube, point):
+    """
+    Counts one condensed data point, a dictionary with the keys of the
+    condensed csv file, into a trip cube. Points with a user type outside of
+    the cube are only counted as skipped.
+    """
+    i = 0
+    for (name, values), index in zip(cube_dimensions, cube['index']):
+        code = index.get(point[name])
+        if code is None:
+            cube['skipped'] += 1
+            return
+        i = i * len(values) + code
+    cube['count'][i] += 1
+    cube['duration'][i] += point['duration']
+    if point['duration'] > 30:
+        cube['long_trips'][i] += 1
+
+
+def close_cube(cube):
+    """
+    Saves a trip cube as a compressed NumPy .npz file and moves it into
+    place.
+    """
+    with open(cube['filename'] + '.tmp', 'wb') as f_out:
+        np.savez_compressed(
+            f_out, count=np.array(cube['count'], dtype=np.int64).reshape(cube_shape),
+            duration=np.array(cube['duration']).reshape(cube_shape),
+            long_trips=np.array(cube['long_trips'], dtype=np.int64).reshape(cube_shape),
+            skipped=cube['skipped'])
+    os.replace(cube['filename'] + '.tmp', cube['filename'])
+    forget_cached_results(cube['filename'])
+
+
+def load_cube(filename):
+    """
+    Reads a trip cube saved by close_cube into a dictionary from each measure
+    to its array, indexed by month, hour, day of week and user type.
+    """
+    with np.load(filename) as arrays:
+        return {name: arrays[name] for name in cube_measures + ['skipped']}
+
+
+def cube_query(cube, measure='count', by=(), **where):
+    """
+    Returns the total of a measure of a trip cube ('count', 'duration' or
+    'long_trips') over the trips matching where, grouped by the dimensions
+    listed in by. Each keyword of where names a dimension and gives a value
+    or a list of values, as in
+    cube_query(cube, by=['hour'], user_type='Customer',
+               day_of_week=['Saturday', 'Sunday']).
+    The result is an array with one axis per dimension of by, in the order
+    of cube_dimensions, or a plain number when by is empty.
+    """
+    names = [name for name, values in cube_dimensions]
+    for name in list(by) + list(where):
+        if name not in names:
+            raise ValueError('unknown cube dimension: {}'.format(name))
+    data = cube[measure]
+    for axis, (name, values) in enumerate(cube_dimensions):
+        if name in where:
+            wanted = where[name]
+            if isinstance(wanted, (str, int)):
+                wanted = [wanted]
+            data = data.take([values.index(value) for value in wanted], axis=axis)
+    summed = tuple(axis for axis, name in enumerate(names) if name not in by)
+    total = data.sum(axis=summed)
+    return total if by else total.item()
+
+
+def cube_from_summary(filename, cube_file=None):
+    """
+    Returns the trip cube of a condensed data file, csv or binary summary, as
+    load_cube would, also saving it as cube_file if given. Csv files are read
+    a block at a time, with durations in double precision.
+    """
+    days = list(day_names)
+    user_types = list(user_type_names)
+    if is_binary_summary(filename):
+        blocks = [read_binary_summary(filename)]
+    else:
+        blocks = iter_trip_blocks(filename, days=days, user_types=user_types,
+                                  duration_dtype=np.float64)
+    size = int(np.prod(cube_shape))
+    cube = {'count': np.zeros(size, dtype=np.int64),
+            'duration': np.zeros(size),
+            'long_trips': np.zeros(size, dtype=np.int64),
+            'skipped': np.int64(0)}
+    for trips in blocks:
+        codes = [trips['month'].astype(np.intp) - 1, trips['hour'].astype(np.intp)]
+        for name, names in [('day_of_week', trips.get('day_names', days)),
+                            ('user_type', trips.get('user_type_names', user_types))]:
+            # map the codes of the file to the positions of the cube, with -1
+            # for names the cube does not have
+            values = dict(cube_dimensions)[name]
+            positions = np.array([values.index(value) if value in values else -1
+                                  for value in names], dtype=np.intp)
+            codes.append(positions[trips[name]])
+        kept = np.all([code >= 0 for code in codes], axis=0)
+        cells = np.ravel_multi_index([code[kept] for code in codes], cube_shape)
+        duration = trips['duration'][kept].astype(np.float64)
+        cube['count'] += np.bincount(cells, minlength=size)
+        cube['duration'] += np.bincount(cells, duration, size)
+        cube['long_trips'] += np.bincount(cells[duration > 30], minlength=size)
+        cube['skipped'] += len(kept) - np.count_nonzero(kept)
+    for measure in cube_measures:
+        cube[measure] = cube[measure].reshape(cube_shape)
+
+    if cube_file:
+        with open(cube_file + '.tmp', 'wb') as f_out:
+            np.savez_compressed(f_out, **cube)
+        os.replace(cube_file + '.tmp', cube_file)
+        forget_cached_results(cube_file)
+    return cube
@@ -0,0 +1,220 @@
+"""
+An SQLite database of condensed trips, which the statistics of the analysis
+can be answered from with indexed SQL instead of scans of the summary files.
+
+The trips of every city go into a single trips table, indexed on city,
+month, hour and user type, with the duration appended to the index so the
+aggregates below are computed from the index alone. The database is kept in
+write-ahead log mode: a city is replaced in one transaction while any number
+of readers, in other threads or processes, keep querying the last committed
+trips.
+"""
+
+import contextlib
+import csv
+import itertools
+import sqlite3
+
+from .adapters import parse_summary_rows
+from .files import open_data_file
+from .instrumentation import count_rows, instrumented
+
+
+database_schema = """
+CREATE TABLE IF NOT EXISTS trips (
+    city TEXT NOT NULL,
+    duration REAL NOT NULL,
+    month INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    day_of_week TEXT NOT NULL,
+    user_type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trips_city_month_hour_user_type
+    ON trips (city, month, hour, user_type, duration);
+"""
+
+
+# rows per executemany call when loading trips
+database_batch_rows = 4096
+
+
+def connect_database(filename, readonly=False):
+    """
+    Returns a connection to a trip database, created with its schema if it
+    does not exist yet, or a read-only connection to an existing one.
+    Transactions are begun and committed explicitly.
+    """
+    if readonly:
+        connection = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True,
+                                     isolation_level=None)
+    else:
+        connection = sqlite3.connect(filename, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode a commit only needs to reach the log, not the database
+        connection.execute('PRAGMA synchronous=NORMAL')
+        # 64 MB of pages, so the index pages a load updates stay in memory
+        connection.execute('PRAGMA cache_size=-65536')
+        connection.executescript(database_schema)
+    return connection
+
+
+def open_database_load(filename, city):
+    """
+    Starts replacing the trips of a city in the trip database filename.
+    Returns the state passed on to add_database_rows and close_database_load;
+    until the load is closed, readers see the trips the city had before.
+    """
+    connection = connect_database(filename)
+    connection.execute('BEGIN IMMEDIATE')
+    connection.execute('DELETE FROM trips WHERE city = ?', (city,))
+    return {'connection': connection, 'city': city, 'rows': 0}
+
+
+def add_database_rows(load, block):
+    """
+    Inserts a block of condensed rows, as (duration, month, hour,
+    day_of_week, user_type) tuples, in the trips of a database load.
+    """
+    city = load['city']
+    load['connection'].executemany(
+        'INSERT INTO trips (city, duration, month, hour, day_of_week, user_type) '
+        'VALUES (?, ?, ?, ?, ?, ?)', [(city,) + tuple(row) for row in block])
+    load['rows'] += len(block)
+
+
+def close_database_load(load):
+    """
+    Commits the trips of a database load, so readers see them all at once,
+    and returns their number. A load that is never closed is rolled back.
+    """
+    load['connection'].execute('COMMIT')
+    load['connection'].close()
+    return load['rows']
+
+
+def abort_database_load(load):
+    """
+    Rolls back a database load that failed, so the city keeps the trips it
+    had before, and closes its connection.
+    """
+    try:
+        load['connection'].execute('ROLLBACK')
+    except sqlite3.Error:
+        # the load was already committed, or its transaction already ended
+        pass
+    load['connection'].close()
+
+
+@instrumented(reads=('filename',))
+def load_summary(database, filename, city):
+    """
+    Replaces the trips of a city in a trip database with the trips of a
+    condensed data file, leaving out malformed rows. Returns the number of
+    trips loaded.
+    """
+    load = open_database_load(database, city)
+    try:
+        with open_data_file(filename) as f_in:
+            reader = csv.reader(f_in)
+            header = next(reader)
+            columns = [header.index(column) for column in
+                       ['duration', 'month', 'hour', 'day_of_week', 'user_type']]
+            while True:
+                rows = list(itertools.islice(reader, database_batch_rows))
+                if not rows:
+                    break
+                # malformed rows, such as a last row cut short, are skipped
+                add_database_rows(load, parse_summary_rows(rows, columns, []))
+        n_rows = close_database_load(load)
+    except BaseException:
+        abort_database_load(load)
+        raise
+    count_rows(n_rows)
+    return n_rows
+
+
+def database_cities(database):
+    """
+    Returns the cities a trip database holds trips of.
+    """
+    with contextlib.closing(connect_database(database, readonly=True)) as connection:
+        return [city for city, in connection.execute(
+            'SELECT DISTINCT city FROM trips ORDER BY city')]
+
+
+def user_type_totals(database, city):
+    # {user_type: (trips, total duration, trips longer than 30 minutes)}
+    with contextlib.closing(connect_database(database, readonly=True)) as connection:
+        return {user_type: (trips, length, long_trips)
+                for user_type, trips, length, long_trips in connection.execute(
+                    'SELECT user_type, COUNT(*), SUM(duration), '
+                    'SUM(duration > 30) FROM trips WHERE city = ? '
+                    'GROUP BY user_type', (city,))}
+
+
+@instrumented(reads=())
+def number_of_trips_sql(database, city):
+    """
+    Returns the same as number_of_trips for the trips of a city in a trip
+    database.
+    """
+    totals = user_type_totals(database, city)
+    n_subscribers = totals.get('Subscriber', (0,))[0]
+    n_customers = sum(trips for user_type, (trips, _, _) in totals.items()
+                      if user_type != 'Subscriber')
+    return (n_subscribers, n_customers, n_subscribers + n_customers)
+
+
+@instrumented(reads=())
+def length_of_trip_sql(database, city):
+    """
+    Returns the same as length_of_trip for the trips of a city in a trip
+    database.
+    """
+    totals = user_type_totals(database, city).values()
+    total_of_trips = sum(trips for trips, _, _ in totals)
+    time_of_trip = sum(length for _, length, _ in totals)
+    trip_above_30 = sum(long_trips for _, _, long_trips in totals)
+    if not total_of_trips:
+        return (None, None)
+    avg_length = round(time_of_trip / total_of_trips, 1)
+    trips_longer_30 = round(float(trip_above_30 / total_of_trips)*100, 1)
+    return (avg_length, trips_longer_30)
+
+
+@instrumented(reads=())
+def duration_ridership_sql(database, city):
+    """
+    Returns the same as duration_ridership for the trips of a city in a trip
+    database.
+    """
+    subscibers = customers = 0
+    sub_length = cus_length = 0.0
+    for user_type, (trips, length, _) in user_type_totals(database, city).items():
+        if user_type == 'Customer':
+            customers += trips
+            cus_length += length
+        else:
+            subscibers += trips
+            sub_length += length
+    sub_avg = round(sub_length / subscibers, 1) if subscibers else None
+    cus_avg = round(cus_length / customers, 1) if customers else None
+    return (subscibers, customers, sub_avg, cus_avg, subscibers + customers)
+
+
+@instrumented(reads=())
+def monthly_trips_sql(database, city):
+    """
+    Returns the lists of the number of Subscriber and Customer trips in each
+    month of a city in a trip database, the counts plotted by
+    total_customers_and_subscribers.
+    """
+    sub_info = [0] * 12
+    cus_info = [0] * 12
+    with contextlib.closing(connect_database(database, readonly=True)) as connection:
+        for month, user_type, trips in connection.execute(
+                'SELECT month, user_type, COUNT(*) FROM trips WHERE city = ? '
+                'GROUP BY month, user_type', (city,)):
+            info = cus_info if user_type == 'Customer' else sub_info
+            info[month - 1] += trips
+    return (sub_info, cus_info)
@@ -0,0 +1,315 @@
+"""
+Opening the data files, compressed or not, and reading them in blocks of
+text, with the members of a multi-member gzip file decompressed in parallel.
+"""
+
+import bz2
+import codecs
+import csv
+import gzip
+import io
+import itertools
+import locale
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# file name suffix -> compression of the file
+compressed_suffixes = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd', '.zstd': 'zstd'}
+
+
+def file_compression(filename):
+    """
+    Returns the compression of a file from its name, or None.
+    """
+    return compressed_suffixes.get(os.path.splitext(filename)[1].lower())
+
+
+def is_quote_wrapped_line(line):
+    """
+    Tells whether the header line of a data file, bytes or text, is wrapped
+    in quotes as a whole, as every line of the data files of this repository
+    is: a single quoted csv field holding the commas of all the columns.
+    """
+    if isinstance(line, bytes):
+        line = line.decode(errors='replace')
+    line = line.rstrip('\r\n')
+    return (len(line) > 1 and line[0] == line[-1] == '"' and ',' in line
+            and len(next(csv.reader([line]))) == 1)
+
+
+def is_quote_wrapped(filename, compression='auto'):
+    """
+    Tells whether every line of a data file is wrapped in quotes.
+    """
+    with open_data_file(filename, 'rb', compression) as f_in:
+        return is_quote_wrapped_line(f_in.readline())
+
+
+class QuoteWrappedReader(io.RawIOBase):
+    """
+    Reads the plain csv lines of a binary data file whose every line is
+    wrapped in quotes, a block of lines at a time.
+    """
+
+    def __init__(self, f_in, read_bytes=2**16):
+        self.f_in = f_in
+        self.read_bytes = read_bytes
+        self.pending = b''
+        self.rest = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            data = self.f_in.read(self.read_bytes)
+            if not data:
+                data, self.rest = self.rest, b''
+                if not data:
+                    return 0
+            else:
+                data = self.rest + data
+                end = data.rfind(b'\n') + 1
+                data, self.rest = data[:end], data[end:]
+            self.pending = unwrap_lines(data)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.f_in.close()
+        super().close()
+
+
+def unwrap_line(line):
+    # a quoted field, with its quotes doubled inside, and any \r after it
+    body = line.rstrip(b'\r')
+    if len(body) > 1 and body[:1] == body[-1:] == b'"':
+        return body[1:-1].replace(b'""', b'"') + line[len(body):]
+    return line
+
+
+def unwrap_lines(data):
+    """
+    Returns a block of lines of a file whose every line is wrapped in quotes,
+    as bytes, with each line unwrapped. Wrapping is per line, so a block
+    starting and ending at line boundaries of the file can be unwrapped on
+    its own, and the byte offsets of the lines in the file stay valid.
+    """
+    return b'\n'.join(unwrap_line(line) for line in data.split(b'\n'))
+
+
+def open_data_file(filename, mode='r', compression='auto', buffering=-1):
+    """
+    Opens a data file like open(), decompressing it as it is read, or
+    compressing it as it is written, if compression is 'gzip', 'bz2' or
+    'zstd'. By default, the compression follows from the name of the file.
+    buffering only applies to uncompressed files. A file whose every line is
+    wrapped in quotes is read in text mode as the csv lines inside them.
+    """
+    if compression == 'auto':
+        compression = file_compression(filename)
+    if mode in ('r', 'rt') and is_quote_wrapped(filename, compression):
+        return io.TextIOWrapper(io.BufferedReader(QuoteWrappedReader(
+            open_data_file(filename, 'rb', compression))))
+    if compression is None:
+        return open(filename, mode, buffering=buffering)
+
+    binary = 'b' in mode
+    if not binary and 't' not in mode:
+        mode += 't'
+    if compression == 'gzip':
+        return gzip.open(filename, mode)
+    if compression == 'bz2':
+        return bz2.open(filename, mode)
+    if compression != 'zstd':
+        raise ValueError('unknown compression: {}'.format(compression))
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('reading or writing {} needs the zstandard '
+                          'package'.format(filename))
+    if 'r' in mode:
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), read_across_frames=True, closefd=True))
+    else:
+        stream = zstandard.ZstdCompressor().stream_writer(
+            open(filename, mode.replace('t', '').replace('b', '') + 'b'),
+            closefd=True)
+    return stream if binary else io.TextIOWrapper(stream)
+
+
+gzip_magic = b'\x1f\x8b\x08'
+
+
+def gzip_member_candidates(filename, read_bytes=2**24):
+    """
+    Returns the offsets of a gzip file where a member may start: every
+    occurrence of the gzip magic bytes, which includes all actual members.
+    """
+    candidates = []
+    with open(filename, 'rb') as f_in:
+        # offset in the file of the first byte of data
+        offset = 0
+        tail = b''
+        while True:
+            chunk = f_in.read(read_bytes)
+            if not chunk:
+                break
+            data = tail + chunk
+            i = data.find(gzip_magic)
+            while i >= 0:
+                candidates.append(offset + i)
+                i = data.find(gzip_magic, i + 1)
+            # carry the end of the data over, in case the magic bytes are split
+            # between two reads
+            tail = data[-(len(gzip_magic) - 1):]
+            offset += len(data) - len(tail)
+    return candidates
+
+
+# decompressed bytes of a gzip member a worker holds at most; longer members
+# are streamed in pieces instead
+gzip_member_bytes = 2**24
+
+
+def decompress_gzip_member(filename, start, read_bytes=2**20,
+                           max_bytes=gzip_member_bytes):
+    """
+    Decompresses the gzip member starting at byte offset start of a file.
+    Returns the offset where the member ends and its data, None if no valid
+    member starts there, or (None, None) if it has more than max_bytes of
+    data, which stream_gzip_member then reads.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    length = 0
+    with open(filename, 'rb') as f_in:
+        f_in.seek(start)
+        position = start
+        try:
+            while not decompressor.eof:
+                data = f_in.read(read_bytes)
+                if not data:
+                    return None
+                position += len(data)
+                parts.append(decompressor.decompress(data))
+                length += len(parts[-1])
+                if length > max_bytes:
+                    return (None, None)
+        except zlib.error:
+            return None
+    return (position - len(decompressor.unused_data), b''.join(parts))
+
+
+def stream_gzip_member(filename, start, read_bytes=2**20):
+    """
+    Yields the data of the gzip member starting at byte offset start of a
+    file in pieces, and returns the offset where the member ends, or None if
+    no valid member starts there.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(filename, 'rb') as f_in:
+        f_in.seek(start)
+        position = start
+        try:
+            while not decompressor.eof:
+                data = f_in.read(read_bytes)
+                if not data:
+                    return None
+                position += len(data)
+                yield decompressor.decompress(data)
+        except zlib.error:
+            return None
+    return position - len(decompressor.unused_data)
+
+
+def gzip_member_blocks(filename, workers=None):
+    """
+    Yields the decompressed data of each member of a gzip file in order,
+    decompressing up to workers members at a time. A file of a single
+    member, and members of more than gzip_member_bytes of data, are
+    streamed in pieces, so no more than a few members are held in memory.
+    """
+    size = os.path.getsize(filename)
+    candidates = gzip_member_candidates(filename)
+    if not candidates or candidates[0] != 0:
+        raise ValueError('{} is not a gzip file'.format(filename))
+    if len(candidates) == 1:
+        # nothing to decompress in parallel
+        position = yield from stream_gzip_member(filename, 0)
+        if position is None:
+            raise ValueError('{} has an invalid gzip member at byte 0'.format(filename))
+        if position != size:
+            raise ValueError('{} has trailing data after byte {}'.format(
+                filename, position))
+        return
+    workers = workers or os.cpu_count()
+    with ThreadPoolExecutor(workers) as executor:
+        jobs = iter(candidates)
+        pending = [(start, executor.submit(decompress_gzip_member, filename, start))
+                   for start in itertools.islice(jobs, 2 * workers)]
+        position = 0
+        while pending:
+            start, job = pending.pop(0)
+            for next_start in itertools.islice(jobs, 1):
+                pending.append((next_start, executor.submit(
+                    decompress_gzip_member, filename, next_start)))
+            if start < position:
+                # magic bytes inside a member already read
+                continue
+            member = job.result()
+            if start == position and member == (None, None):
+                # too long to hold whole
+                member_start = position
+                position = yield from stream_gzip_member(filename, member_start)
+                if position is None:
+                    raise ValueError('{} has an invalid gzip member at byte '
+                                     '{}'.format(filename, member_start))
+                continue
+            if start > position or member is None:
+                raise ValueError('{} has an invalid gzip member at byte '
+                                 '{}'.format(filename, position))
+            position, data = member
+            yield data
+    if position != size:
+        raise ValueError('{} has trailing data after byte {}'.format(filename, position))
+
+
+def read_text_blocks(filename, block_bytes, workers=None):
+    """
+    Yields the text of a data file in blocks of about block_bytes characters
+    that end at a line boundary, decoded as open() would decode it. With
+    workers, multi-member gzip files are decompressed in parallel.
+    """
+    if (workers and file_compression(filename) == 'gzip'
+            and not is_quote_wrapped(filename)):
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+            translate=True)
+        def texts():
+            for data in gzip_member_blocks(filename, workers):
+                for i in range(0, len(data), block_bytes):
+                    yield decoder.decode(data[i:i + block_bytes])
+            yield decoder.decode(b'', final=True)
+    else:
+        def texts():
+            with open_data_file(filename, 'r') as f_in:
+                while True:
+                    text = f_in.read(block_bytes)
+                    if not text:
+                        break
+                    yield text
+
+    rest = ''
+    for text in texts():
+        text = rest + text
+        end = text.rfind('\n') + 1
+        rest = text[end:]
+        if end:
+            yield text[:end]
+    if rest:
+        yield rest
@@ -0,0 +1,269 @@
+"""
+Block indexes of summary files, so that filtered queries only read the
+blocks of a file that can hold matching trips.
+
+A summary file is cut into blocks of whole rows. For every block the index
+keeps its byte range in the file, its number of rows, the smallest and
+largest duration, month and hour of its trips, and bitmaps of the user
+types and days of the week found in it. Since summary files follow the
+order of the raw files, which is the order of the start times, the trips of
+a month sit in a few consecutive blocks.
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+
+from .adapters import parse_summary_rows
+from .files import file_compression, is_quote_wrapped_line, unwrap_lines
+from .instrumentation import count_rows, instrumented
+
+
+# rows per block of the index
+index_block_rows = 4096
+
+
+def index_path(filename):
+    """
+    Returns the name of the file holding the block index of a summary file.
+    """
+    return filename + '.index.json'
+
+
+def new_index(header):
+    """
+    Returns an empty block index of a summary file with the given header.
+    """
+    return {'header': header, 'user_types': [], 'days': [], 'offsets': [],
+            'rows': [], 'duration': [], 'month': [], 'hour': [],
+            'user_type_bits': [], 'day_bits': []}
+
+
+def name_bits(names, values):
+    # bitmap of the positions of values in names, which gets new values added
+    bits = 0
+    for value in values:
+        if value not in names:
+            names.append(value)
+        bits |= 1 << names.index(value)
+    return bits
+
+
+def add_index_block(index, start, end, block):
+    """
+    Adds to an index a block of condensed rows, as (duration, month, hour,
+    day_of_week, user_type) tuples, that takes bytes start to end of the
+    summary file.
+    """
+    durations, months, hours, days, user_types = zip(*block)
+    index['offsets'].append([start, end])
+    index['rows'].append(len(block))
+    index['duration'].append([min(durations), max(durations)])
+    index['month'].append([min(months), max(months)])
+    index['hour'].append([min(hours), max(hours)])
+    index['day_bits'].append(name_bits(index['days'], set(days)))
+    index['user_type_bits'].append(name_bits(index['user_types'], set(user_types)))
+
+
+def save_index(index, filename):
+    """
+    Saves the block index of a summary file next to it, stamped with the
+    size and modification time the file has now.
+    """
+    stat = os.stat(filename)
+    index['summary'] = [stat.st_size, stat.st_mtime_ns]
+    with open(index_path(filename) + '.tmp', 'w') as f_out:
+        json.dump(index, f_out)
+    os.replace(index_path(filename) + '.tmp', index_path(filename))
+
+
+def build_index(filename, block_rows=index_block_rows):
+    """
+    Builds and saves the block index of a summary file that was condensed
+    without one.
+    """
+    if file_compression(filename):
+        raise ValueError('a compressed file cannot be read from an offset, '
+                         'so {} cannot be indexed'.format(filename))
+    with open(filename, 'rb') as f_in:
+        header_line = f_in.readline()
+        # the offsets are those of the lines in the file as it is, which a
+        # file whose lines are wrapped in quotes keeps when they are unwrapped
+        wrapped = is_quote_wrapped_line(header_line)
+        if wrapped:
+            header_line = unwrap_lines(header_line)
+        header = next(csv.reader([header_line.decode()]))
+        if header != ['duration', 'month', 'hour', 'day_of_week', 'user_type']:
+            raise ValueError('{} is not a summary file'.format(filename))
+        index = new_index(header)
+        start = f_in.tell()
+        while True:
+            lines = list(itertools.islice(f_in, block_rows))
+            if not lines:
+                break
+            end = start + sum(len(line) for line in lines)
+            data = b''.join(lines)
+            if wrapped:
+                data = unwrap_lines(data)
+            rows = csv.reader(io.StringIO(data.decode()))
+            # malformed rows, such as a last row cut short, are skipped
+            block = parse_summary_rows(rows, range(5), [])
+            if block:
+                add_index_block(index, start, end, block)
+            start = end
+    save_index(index, filename)
+    return index
+
+
+def summary_index(filename):
+    """
+    Returns the block index of a summary file, loaded from the file saved
+    next to it if the summary has not changed since, and built otherwise.
+    """
+    stat = os.stat(filename)
+    try:
+        with open(index_path(filename)) as f_in:
+            index = json.load(f_in)
+        if index['summary'] == [stat.st_size, stat.st_mtime_ns]:
+            return index
+    except FileNotFoundError:
+        pass
+    return build_index(filename)
+
+
+def as_set(values):
+    # a single value or any collection of them
+    if values is None:
+        return None
+    if isinstance(values, (str, int)):
+        return {values}
+    return set(values)
+
+
+def matching_blocks(index, user_type=None, months=None, hours=None, days=None,
+                    min_duration=None, max_duration=None):
+    """
+    Returns the numbers of the blocks of an index that may hold trips
+    matching the filters: a user type, collections of months, hours and day
+    names, and a duration range that includes both ends. Filters left as
+    None match every trip.
+    """
+    user_types, months, hours, days = [as_set(values) for values in
+                                       [user_type, months, hours, days]]
+    user_type_mask = (None if user_types is None else
+                      sum(1 << i for i, name in enumerate(index['user_types'])
+                          if name in user_types))
+    day_mask = (None if days is None else
+                sum(1 << i for i, name in enumerate(index['days']) if name in days))
+
+    blocks = []
+    for i in range(len(index['rows'])):
+        low, high = index['duration'][i]
+        if min_duration is not None and high < min_duration:
+            continue
+        if max_duration is not None and low > max_duration:
+            continue
+        if months is not None:
+            low, high = index['month'][i]
+            if not any(low <= month <= high for month in months):
+                continue
+        if hours is not None:
+            low, high = index['hour'][i]
+            if not any(low <= hour <= high for hour in hours):
+                continue
+        if user_type_mask is not None and not index['user_type_bits'][i] & user_type_mask:
+            continue
+        if day_mask is not None and not index['day_bits'][i] & day_mask:
+            continue
+        blocks.append(i)
+    return blocks
+
+
+def read_index_blocks(filename, index, blocks):
+    """
+    Yields the rows of some blocks of an indexed summary file as
+    (duration, month, hour, day_of_week, user_type) tuples, skipping
+    malformed rows. Runs of consecutive blocks are read with a single read.
+    """
+    runs = []
+    for i in blocks:
+        start, end = index['offsets'][i]
+        if runs and runs[-1][1] == start:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+
+    n_rows = 0
+    try:
+        with open(filename, 'rb') as f_in:
+            wrapped = is_quote_wrapped_line(f_in.readline())
+            for start, end in runs:
+                f_in.seek(start)
+                data = f_in.read(end - start)
+                if wrapped:
+                    data = unwrap_lines(data)
+                trips = parse_summary_rows(csv.reader(io.StringIO(data.decode())),
+                                           range(5), [])
+                n_rows += len(trips)
+                yield from trips
+    finally:
+        count_rows(n_rows)
+
+
+def trip_matcher(user_type=None, months=None, hours=None, days=None,
+                 min_duration=None, max_duration=None):
+    """
+    Returns a function telling if a (duration, month, hour, day_of_week,
+    user_type) trip matches the filters of matching_blocks.
+    """
+    user_types, months, hours, days = [as_set(values) for values in
+                                       [user_type, months, hours, days]]
+
+    def matches(trip):
+        duration, month, hour, day_of_week, name = trip
+        return ((user_types is None or name in user_types) and
+                (months is None or month in months) and
+                (hours is None or hour in hours) and
+                (days is None or day_of_week in days) and
+                (min_duration is None or duration >= min_duration) and
+                (max_duration is None or duration <= max_duration))
+    return matches
+
+
+def filtered_trips(filename, user_type=None, months=None, hours=None, days=None,
+                   min_duration=None, max_duration=None):
+    """
+    Yields the trips of a summary file that match the filters of
+    matching_blocks, as (duration, month, hour, day_of_week, user_type)
+    tuples in file order, reading only the blocks that may hold them.
+    """
+    index = summary_index(filename)
+    blocks = matching_blocks(index, user_type, months, hours, days,
+                             min_duration, max_duration)
+    matches = trip_matcher(user_type, months, hours, days, min_duration, max_duration)
+    return filter(matches, read_index_blocks(filename, index, blocks))
+
+
+@instrumented()
+def query_trips(filename, user_type=None, months=None, hours=None, days=None,
+                min_duration=None, max_duration=None):
+    """
+    Returns the number and average duration of the trips of a summary file
+    that match the filters of matching_blocks, along with the number of
+    blocks read out of all the blocks of the file.
+    """
+    index = summary_index(filename)
+    blocks = matching_blocks(index, user_type, months, hours, days,
+                             min_duration, max_duration)
+    matches = trip_matcher(user_type, months, hours, days, min_duration, max_duration)
+    n_trips = 0
+    total_duration = 0.0
+    for trip in filter(matches, read_index_blocks(filename, index, blocks)):
+        n_trips += 1
+        total_duration += trip[0]
+    return {'trips': n_trips,
+            'average_duration': total_duration / n_trips if n_trips else None,
+            'blocks_read': len(blocks),
+            'blocks': len(index['rows'])}
@@ -0,0 +1,162 @@
+"""
+Opt-in metrics of the calls of the condense and statistics functions:
+wall time, rows, bytes read and written, and peak memory.
+"""
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+
+# the calls being measured, innermost last, while collect_metrics runs, and
+# None otherwise
+metric_stack = None
+
+
+# the metrics collect_metrics is filling in
+collected_metrics = None
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident memory of the process in bytes, or None where
+    the resource module does not exist, as on Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+@contextlib.contextmanager
+def collect_metrics(memory=False):
+    """
+    Records the metrics of every instrumented call made inside the with
+    block into the dictionary it yields. With memory, the peak memory
+    allocated by each call is traced as well, which slows the calls down.
+    """
+    global metric_stack, collected_metrics
+    if metric_stack is not None:
+        raise RuntimeError('metrics are already being collected')
+    metrics = {'calls': [], 'stages': {}}
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    metric_stack = []
+    collected_metrics = metrics
+    try:
+        yield metrics
+    finally:
+        metric_stack = None
+        collected_metrics = None
+        if tracing:
+            tracemalloc.stop()
+        for call in metrics['calls']:
+            totals = metrics['stages'].setdefault(call['stage'], {
+                'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes_read': 0,
+                'bytes_written': 0, 'peak_memory': None})
+            totals['calls'] += 1
+            for name in ['seconds', 'rows', 'bytes_read', 'bytes_written']:
+                totals[name] += call[name]
+            if call['peak_memory'] is not None:
+                totals['peak_memory'] = max(totals['peak_memory'] or 0,
+                                            call['peak_memory'])
+        for totals in metrics['stages'].values():
+            totals['rows_per_second'] = (totals['rows'] / totals['seconds']
+                                         if totals['seconds'] else None)
+        peak_rss = peak_rss_bytes()
+        metrics['max_rss_kb'] = peak_rss // 1024 if peak_rss is not None else None
+
+
+def save_metrics(metrics, filename):
+    """
+    Saves the metrics of collect_metrics as JSON.
+    """
+    with open(filename, 'w') as f_out:
+        json.dump(metrics, f_out, indent=1)
+
+
+def count_rows(n_rows):
+    """
+    Adds n_rows processed rows to the calls being measured.
+    """
+    if metric_stack:
+        for call in metric_stack:
+            call['rows'] += n_rows
+
+
+def add_stage_time(stage, seconds):
+    """
+    Adds time spent in one stage of the innermost call being measured.
+    """
+    if metric_stack:
+        stages = metric_stack[-1]['substages']
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except (OSError, TypeError):
+        return 0
+
+
+def instrumented(reads=('filename',), writes=()):
+    """
+    Decorates a function so its calls are measured while collect_metrics
+    runs. reads and writes name the arguments of the function holding the
+    files it reads and writes.
+    """
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def measured(*args, **kwargs):
+            if metric_stack is None:
+                return function(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs).arguments
+            call = {'stage': function.__name__, 'rows': 0, 'substages': {},
+                    'bytes_read': sum(file_size(arguments.get(name))
+                                      for name in reads),
+                    'peak_memory': None, 'inner_peak': 0}
+            tracing = tracemalloc.is_tracing()
+            if tracing:
+                start_memory = tracemalloc.get_traced_memory()[0]
+                # the peak of an enclosing call is carried over, as it is
+                # reset for this one
+                if metric_stack:
+                    metric_stack[-1]['inner_peak'] = max(
+                        metric_stack[-1]['inner_peak'],
+                        tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            metric_stack.append(call)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                call['seconds'] = time.perf_counter() - start
+                metric_stack.pop()
+                if tracing:
+                    peak = max(tracemalloc.get_traced_memory()[1],
+                               call['inner_peak'])
+                    call['peak_memory'] = peak - start_memory
+                    if metric_stack:
+                        metric_stack[-1]['inner_peak'] = max(
+                            metric_stack[-1]['inner_peak'], peak)
+                del call['inner_peak']
+                call['bytes_written'] = sum(file_size(arguments.get(name))
+                                            for name in writes)
+                call['rows_per_second'] = (call['rows'] / call['seconds']
+                                           if call['seconds'] else None)
+                collected_metrics['calls'].append(call)
+        return measured
+    return decorate
@@ -0,0 +1,100 @@
+"""
+Streaming moments of trip durations: the count, mean, variance, shortest and
+longest of any number of values, kept in constant memory and mergeable.
+
+The variance is kept with Welford's update, which never subtracts two large
+sums from each other, and the total with Neumaier's compensated summation,
+which carries the rounding error of every addition along with the sum.
+Moments of different chunks, threads or cities are merged with the pairwise
+formulas of Chan et al., so the moments of a whole file do not depend on how
+it was cut into parts: the means and variances computed serially and in
+parallel agree to within moments_tolerance of each other, relatively.
+"""
+
+import math
+
+
+# relative difference allowed between the means, variances and standard
+# deviations of the same values added in different orders or parts
+moments_tolerance = 1e-9
+
+
+def new_moments():
+    """
+    Returns empty moments as a JSON-friendly dictionary.
+    """
+    return {'n': 0, 'mean': 0.0, 'm2': 0.0, 'sum': 0.0, 'compensation': 0.0,
+            'min': math.inf, 'max': -math.inf}
+
+
+def compensated_add(moments, value):
+    # Neumaier's variant of Kahan summation, which also holds when the value
+    # added is larger than the sum so far
+    total = moments['sum'] + value
+    if abs(moments['sum']) >= abs(value):
+        moments['compensation'] += (moments['sum'] - total) + value
+    else:
+        moments['compensation'] += (value - total) + moments['sum']
+    moments['sum'] = total
+
+
+def add_to_moments(moments, value):
+    n = moments['n'] = moments['n'] + 1
+    delta = value - moments['mean']
+    moments['mean'] += delta / n
+    moments['m2'] += delta * (value - moments['mean'])
+    compensated_add(moments, value)
+    if value < moments['min']:
+        moments['min'] = value
+    if value > moments['max']:
+        moments['max'] = value
+
+
+def block_moments(n, total, m2, low, high):
+    """
+    Returns the moments of a block of n values from their total, the sum of
+    their squared differences from their mean, and their smallest and largest
+    value, as computed in one go over an array.
+    """
+    if not n:
+        return new_moments()
+    return {'n': n, 'mean': total / n, 'm2': m2, 'sum': total,
+            'compensation': 0.0, 'min': low, 'max': high}
+
+
+def merge_moments(moments, other):
+    """
+    Folds the moments of other values into moments, as if they had been
+    added one by one.
+    """
+    if not other['n']:
+        return moments
+    n = moments['n'] + other['n']
+    delta = other['mean'] - moments['mean']
+    moments['mean'] += delta * other['n'] / n
+    moments['m2'] += other['m2'] + delta * delta * moments['n'] * other['n'] / n
+    moments['n'] = n
+    compensated_add(moments, other['sum'])
+    compensated_add(moments, other['compensation'])
+    moments['min'] = min(moments['min'], other['min'])
+    moments['max'] = max(moments['max'], other['max'])
+    return moments
+
+
+def moments_summary(moments):
+    """
+    Returns the count, mean, sample variance, standard deviation, minimum
+    and maximum of moments. The mean is taken from the compensated total;
+    all but the count are None when there are no values.
+    """
+    n = moments['n']
+    if not n:
+        return {'count': 0, 'mean': None, 'variance': None, 'stddev': None,
+                'min': None, 'max': None}
+    variance = moments['m2'] / (n - 1) if n > 1 else 0.0
+    return {'count': n,
+            'mean': (moments['sum'] + moments['compensation']) / n,
+            'variance': variance,
+            'stddev': math.sqrt(variance),
+            'min': moments['min'],
+            'max': moments['max']}
@@ -0,0 +1,140 @@
+"""
+Statistics of files larger than memory, computed block by block on numpy
+columns and merged.
+"""
+
+import math
+
+import numpy as np
+
+from .columns import iter_trip_blocks, user_type_names
+from .instrumentation import instrumented
+from .moments import block_moments
+from .sketches import extend_sketch, new_sketch
+from .statistics import (merge_duration_histograms, merge_duration_moments,
+                         merge_duration_range, merge_duration_sketches, merge_months,
+                         merge_trip_length, merge_user_types, new_histogram,
+                         question_5_bins, summary_statistics)
+
+
+def block_user_types(state, trips, names):
+    for code, name in enumerate(names):
+        mask = trips['user_type'] == code
+        trips_of_type = int(np.count_nonzero(mask))
+        if trips_of_type:
+            merge_user_types(state, {name: [trips_of_type,
+                                            float(trips['duration'][mask].sum())]})
+
+
+def block_trip_length(state, trips, names):
+    duration = trips['duration']
+    merge_trip_length(state, [len(duration), float(duration.sum()),
+                              int(np.count_nonzero(duration > 30))])
+
+
+def block_months(state, trips, names):
+    for code, name in enumerate(names):
+        counts = np.bincount(trips['month'][trips['user_type'] == code], minlength=13)
+        if counts.any():
+            merge_months(state, {name: {str(i): int(counts[i]) for i in range(1, 13)}})
+
+
+def block_duration_range(state, trips, names):
+    if len(trips['duration']):
+        merge_duration_range(state, [float(trips['duration'].min()),
+                                     float(trips['duration'].max())])
+
+
+def block_duration_moments(state, trips, names):
+    for code, name in enumerate(names):
+        durations = trips['duration'][trips['user_type'] == code]
+        if len(durations):
+            # an exactly rounded total, and squared differences from the mean
+            # of the block rather than from zero
+            total = math.fsum(durations.tolist())
+            m2 = float(np.square(durations - total / len(durations)).sum())
+            merge_duration_moments(state, {name: block_moments(
+                len(durations), total, m2, float(durations.min()),
+                float(durations.max()))})
+
+
+def block_duration_histograms(state, trips, names):
+    edges = new_histogram(question_5_bins)['edges']
+    for code, name in enumerate(names):
+        durations = trips['duration'][trips['user_type'] == code]
+        if len(durations):
+            counts, _ = np.histogram(durations, edges)
+            merge_duration_histograms(state, {name: {'edges': edges,
+                                                     'counts': counts.tolist()}})
+
+
+def block_duration_sketches(state, trips, names):
+    for code, name in enumerate(names):
+        mask = trips['user_type'] == code
+        if not mask.any():
+            continue
+        partial = {'month': {}, 'hour': {}}
+        for dimension in ['month', 'hour']:
+            values = trips[dimension][mask]
+            for key in np.unique(values):
+                sketch = partial[dimension][str(key)] = new_sketch()
+                extend_sketch(sketch, trips['duration'][mask][values == key].tolist())
+        merge_duration_sketches(state, {name: partial})
+
+
+# name -> update(state, trips, user_type_names) folding a block of columns
+# into the state of a registered statistic
+block_updates = {'user_types': block_user_types,
+                 'trip_length': block_trip_length,
+                 'months': block_months,
+                 'duration_range': block_duration_range,
+                 'duration_moments': block_duration_moments,
+                 'duration_histograms': block_duration_histograms,
+                 'duration_sketches': block_duration_sketches}
+
+
+# rough peak bytes per row of a block while it is parsed, for condensed
+# summary files and for raw city files
+block_row_bytes = {'summary': 512, 'raw': 2048}
+
+
+def merge_statistics(states, other):
+    """
+    Merges the partial states of other into states, both dictionaries of
+    statistic states as kept by out_of_core_statistics.
+    """
+    for name, state in other.items():
+        if name in states:
+            summary_statistics[name][3](states[name], state)
+        else:
+            states[name] = state
+    return states
+
+
+@instrumented(reads=())
+def out_of_core_statistics(files, memory_budget=256 * 2**20):
+    """
+    Computes the registered statistics of a list of (filename, city) pairs,
+    where city is None for condensed summary files, reading no more rows at
+    a time than fit in memory_budget bytes. Returns the same dictionary as
+    scan_summary for the statistics that can be computed in blocks.
+    """
+    names = [name for name in summary_statistics if name in block_updates]
+    states = {name: summary_statistics[name][0]() for name in names}
+    for filename, city in files:
+        row_bytes = block_row_bytes['summary' if city is None else 'raw']
+        block_rows = max(1000, memory_budget // row_bytes)
+        user_types = list(user_type_names)
+        for trips in iter_trip_blocks(filename, city, block_rows,
+                                      user_types=user_types,
+                                      duration_dtype=np.float64):
+            partial = {name: summary_statistics[name][0]() for name in names}
+            for name in names:
+                block_updates[name](partial[name], trips, user_types)
+            merge_statistics(states, partial)
+
+    results = {}
+    for name in names:
+        finish = summary_statistics[name][2]
+        results[name] = finish(states[name]) if finish else states[name]
+    return results
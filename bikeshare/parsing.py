@@ -0,0 +1,76 @@
+"""
+Parsing of the start times of trips into their month, hour and day of the
+week, with every date and clock time parsed only once.
+"""
+
+from datetime import datetime
+
+
+# date string -> (month, day of week) of every start date parsed so far
+trip_dates = {}
+
+
+# hour string -> hour of every start hour parsed so far
+trip_hours = {}
+
+
+# clock format -> {minutes (and seconds) string: True} of every start time
+# parsed so far, the part of the clock after the hour
+trip_minutes = {'%H:%M': {}, '%H:%M:%S': {}}
+
+
+def parse_new_start_time(value, clock_format):
+    """
+    Parses a start time string with datetime.strptime, so malformed strings
+    raise exactly as before, and remembers its date, hour and minutes.
+    """
+    d = datetime.strptime(value, '%m/%d/%Y ' + clock_format)
+    parts = value.split(' ')
+    if len(parts) == 2:
+        hour, minutes = parts[1].split(':', 1)
+        trip_dates[parts[0]] = (d.month, d.strftime('%A'))
+        trip_hours[hour] = d.hour
+        trip_minutes[clock_format][minutes] = True
+    return (d.month, d.hour, d.strftime('%A'))
+
+
+def parse_start_time(value, clock_format):
+    """
+    Returns the month, hour and day of the week of a start time string in the
+    '%m/%d/%Y ' + clock_format format, the same values datetime.strptime
+    would give.
+    """
+    try:
+        date, clock = value.split(' ')
+        hour, minutes = clock.split(':', 1)
+        trip_minutes[clock_format][minutes]
+        month, day_of_week = trip_dates[date]
+        return (month, trip_hours[hour], day_of_week)
+    except (KeyError, ValueError):
+        return parse_new_start_time(value, clock_format)
+
+
+def parse_start_times(values, clock_format):
+    """
+    Batch version of parse_start_time for a whole column of start time
+    strings. Returns the lists of months, hours and days of the week.
+    """
+    dates = trip_dates
+    known_hours = trip_hours
+    known_minutes = trip_minutes[clock_format]
+    months = []
+    hours = []
+    days = []
+    for value in values:
+        try:
+            date, clock = value.split(' ')
+            hour, minutes = clock.split(':', 1)
+            known_minutes[minutes]
+            month, day_of_week = dates[date]
+            hour = known_hours[hour]
+        except (KeyError, ValueError):
+            month, hour, day_of_week = parse_new_start_time(value, clock_format)
+        months.append(month)
+        hours.append(hour)
+        days.append(day_of_week)
+    return (months, hours, days)
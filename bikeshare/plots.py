@@ -0,0 +1,190 @@
+"""
+The charts of the analysis, drawn with matplotlib on the Agg backend and
+saved to files. matplotlib is only imported once a chart is drawn, so the
+statistics never pay for loading it.
+
+The charts are drawn from precomputed aggregates rather than from the data
+files: chart_aggregates reads what every chart of a city needs, and
+render_charts draws the charts of many cities on a pool of processes,
+skipping every chart whose aggregates have not changed since it was last
+saved.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .statistics import duration_histogram, monthly_trips, question_5_bins
+
+
+month_labels = ['Jan', 'Feb', 'Mar', 'Apr', 'may', 'Jun', 'July', 'Aug', 'Sep',
+                'Oct', 'Nov', 'Dec']
+
+# bumped whenever the drawing of a chart changes, so saved charts are redrawn
+chart_version = 1
+
+# name of the file listing the hash of every chart saved in a directory
+chart_manifest = 'charts.json'
+
+# chart name -> (figure, axes) of the process, reused from chart to chart
+chart_figures = {}
+
+
+def chart_aggregates(filename):
+    """
+    Returns what the charts of a condensed data file are drawn from, as
+    plain lists: the histograms of all trip durations in ten bins and of the
+    Subscriber and Customer durations under 75 minutes, and the trips of
+    each user type per month.
+    """
+    sub_months, cus_months = monthly_trips(filename)
+    return {'trip-durations': duration_histogram(filename, 10),
+            'subscriber-durations': duration_histogram(filename, question_5_bins,
+                                                       'Subscriber'),
+            'customer-durations': duration_histogram(filename, question_5_bins,
+                                                     'Customer'),
+            'monthly-trips': (sub_months, cus_months)}
+
+
+def aggregate_hash(city, name, aggregate):
+    """
+    Returns a hash of everything a chart is drawn from.
+    """
+    key = json.dumps([chart_version, city, name, aggregate])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def chart_figure(name):
+    """
+    Returns the figure and axes of a chart, cleared of what was drawn on
+    them before. Building a figure costs more than drawing on it, so each
+    process keeps one per chart.
+    """
+    if name not in chart_figures:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        chart_figures[name] = (figure, figure.add_subplot())
+    figure, axes = chart_figures[name]
+    axes.clear()
+    return figure, axes
+
+
+def draw_histogram(axes, aggregate, title, xlabel, ylabel):
+    counts, edges = aggregate
+    axes.stairs(counts, edges, fill=True)
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+
+
+def draw_monthly_trips(axes, aggregate):
+    sub_info, cus_info = aggregate
+    bins = range(1, 13)
+    axes.bar(bins, sub_info, color='y', width=0.6, label='Subscriber')
+    axes.bar(bins, cus_info, color='b', width=0.6, label='Customer')
+    axes.set_title('Total of Customers and Subscribers per months')
+    axes.set_xlabel('Month')
+    axes.set_xticks(bins, month_labels)
+    axes.set_ylabel('count of users')
+    axes.legend()
+
+
+def draw_chart(axes, city, name, aggregate):
+    if name == 'trip-durations':
+        draw_histogram(axes, aggregate, 'city: ' + city, 'Duration of trip',
+                       'Count of users')
+    elif name == 'subscriber-durations':
+        draw_histogram(axes, aggregate,
+                       'Trip distribution for Subscribers in ' + city + ' city',
+                       'Trip Duration (minutes)', 'Count of Subscriber users')
+    elif name == 'customer-durations':
+        draw_histogram(axes, aggregate,
+                       'Trip distribution for Customer in ' + city + ' city',
+                       'Trip Duration(mins)', 'Count of Customer users')
+    elif name == 'monthly-trips':
+        draw_monthly_trips(axes, aggregate)
+    else:
+        raise ValueError('unknown chart: {}'.format(name))
+
+
+def chart_path(directory, city, name, extension):
+    return os.path.join(directory, '{}-{}.{}'.format(city, name, extension))
+
+
+def render_city_charts(city, charts, directory, formats):
+    """
+    Draws the charts {name: aggregate} of a city and saves each of them to
+    directory in every one of formats. Returns the paths written.
+    """
+    paths = []
+    for name, aggregate in charts.items():
+        figure, axes = chart_figure(name)
+        draw_chart(axes, city, name, aggregate)
+        for extension in formats:
+            path = chart_path(directory, city, name, extension)
+            figure.savefig(path + '.tmp', format=extension)
+            os.replace(path + '.tmp', path)
+            paths.append(path)
+    return paths
+
+
+def load_chart_manifest(directory):
+    try:
+        with open(os.path.join(directory, chart_manifest)) as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+
+
+def render_charts(aggregates, directory, formats=('png',), workers=None):
+    """
+    Saves the charts of every city of aggregates, {city: the result of
+    chart_aggregates}, to directory as files named like
+    NYC-monthly-trips.png, in each of formats ('png', 'svg', 'jpg', ...).
+    The cities are drawn on a pool of workers processes (by default one per
+    CPU). A chart is only drawn again when the hash of its aggregate has
+    changed or one of its files is missing. Returns the paths written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_chart_manifest(directory)
+    pending = {}
+    for city, charts in aggregates.items():
+        for name, aggregate in charts.items():
+            digest = aggregate_hash(city, name, aggregate)
+            saved = all(os.path.exists(chart_path(directory, city, name, extension))
+                        for extension in formats)
+            if manifest.get(city, {}).get(name) != digest or not saved:
+                pending.setdefault(city, {})[name] = (aggregate, digest)
+
+    paths = []
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = {city: executor.submit(
+                        render_city_charts, city,
+                        {name: aggregate for name, (aggregate, _) in charts.items()},
+                        directory, formats)
+                    for city, charts in pending.items()}
+            for city, job in jobs.items():
+                paths.extend(job.result())
+                for name, (_, digest) in pending[city].items():
+                    manifest.setdefault(city, {})[name] = digest
+
+        manifest_file = os.path.join(directory, chart_manifest)
+        with open(manifest_file + '.tmp', 'w') as f_out:
+            json.dump(manifest, f_out, indent=1, sort_keys=True)
+        os.replace(manifest_file + '.tmp', manifest_file)
+    return paths
+
+
+def save_charts(city_files, directory, formats=('png',), workers=None):
+    """
+    Saves the charts of the condensed data files {city: filename} to
+    directory with render_charts. Returns the paths written.
+    """
+    aggregates = {city: chart_aggregates(filename)
+                  for city, filename in city_files.items()}
+    return render_charts(aggregates, directory, formats, workers)
@@ -0,0 +1,375 @@
+"""
+A long-running query service answering the statistics of the summary files
+of a few cities as JSON over HTTP, on a local TCP port or a Unix socket.
+
+    python -m bikeshare serve data/*-Summary.csv --port 8000
+    curl localhost:8000/cities/NYC
+
+Every summary file is loaded once into numpy columns, and its report is
+computed as it loads, so most requests are dictionary lookups. Histograms
+with other bins are computed from the columns in memory. A watcher thread
+checks the size and modification time of the files and reloads a city whose
+summary changed, swapping in the new data once it is ready, so requests
+never wait on a reload. Requests are handled on a pool of threads.
+
+The service answers GET requests for
+
+    /cities                       the cities served and their files
+    /cities/<city>                the report of `bikeshare report --json`
+    /cities/<city>/trips          trips per user type and in total
+    /cities/<city>/trip-length    average duration and share over 30 minutes
+    /cities/<city>/user-types     trips and average duration per user type
+    /cities/<city>/monthly        trips per user type in each month
+    /cities/<city>/histogram      counts and edges of the trip durations,
+                                  with ?bins=10 or ?bins=0,5,10,... and
+                                  optionally ?user_type=Customer
+"""
+
+import http.client
+import json
+import math
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from .binary import is_binary_summary
+from .columns import (day_names, iter_trip_blocks, read_binary_summary,
+                      user_type_names)
+from .statistics import equal_bin_edges, question_5_bins
+
+
+# histograms kept with each dataset, beyond those of the charts
+kept_histograms = 256
+
+
+def file_stamp(filename):
+    stat_result = os.stat(filename)
+    return (stat_result.st_size, stat_result.st_mtime_ns)
+
+
+def city_columns(filename):
+    """
+    Returns the columns of a condensed data file, csv or binary summary, as
+    iter_trip_blocks gives them but with durations in double precision.
+    """
+    if is_binary_summary(filename):
+        trips = dict(read_binary_summary(filename))
+        trips['duration'] = trips['duration'].astype(np.float64)
+        return trips
+    days = list(day_names)
+    user_types = list(user_type_names)
+    blocks = list(iter_trip_blocks(filename, days=days, user_types=user_types,
+                                   duration_dtype=np.float64))
+    trips = {name: np.concatenate([block[name] for block in blocks]) if blocks
+             else np.zeros(0, np.float64 if name == 'duration' else np.uint8)
+             for name in ['duration', 'month', 'hour', 'day_of_week', 'user_type']}
+    trips['day_names'] = days
+    trips['user_type_names'] = user_types
+    return trips
+
+
+def average(durations):
+    # the exactly rounded sum, as the compensated sums of the scans give
+    if not len(durations):
+        return None
+    return round(math.fsum(durations.tolist()) / len(durations), 1)
+
+
+def column_report(city, trips):
+    """
+    Returns the report summary_report gives for a summary file, computed
+    from its columns.
+    """
+    duration = trips['duration']
+    names = trips['user_type_names']
+    # summary user types are Subscriber or Customer, and the counts, averages
+    # and monthly trips below all take every trip but the Customers' as a
+    # Subscriber's, so the user types of a report always add up
+    is_customer = trips['user_type'] == (names.index('Customer')
+                                         if 'Customer' in names else -1)
+    n_total = len(duration)
+    n_customers = int(np.count_nonzero(is_customer))
+    longer_30 = int(np.count_nonzero(duration > 30))
+    monthly = {}
+    for user_type, mask in [('Subscriber', ~is_customer), ('Customer', is_customer)]:
+        monthly[user_type] = np.bincount(trips['month'][mask], minlength=13)[1:13].tolist()
+    return {'city': city,
+            'trips': {'Subscriber': n_total - n_customers,
+                      'Customer': n_customers, 'total': n_total},
+            'average_duration': average(duration),
+            'percent_longer_than_30': (round(float(longer_30 / n_total) * 100, 1)
+                                       if n_total else None),
+            'average_duration_by_user_type': {
+                'Subscriber': average(duration[~is_customer]),
+                'Customer': average(duration[is_customer])},
+            'monthly_trips': monthly}
+
+
+def load_city(city, filename):
+    """
+    Loads the summary file of a city into the dataset a service answers
+    from: its columns, its report and the stamp of the file it was read from.
+    """
+    # stamped before reading, so a change during the load triggers a reload
+    stamp = file_stamp(filename)
+    trips = city_columns(filename)
+    dataset = {'city': city, 'filename': filename, 'stamp': stamp, 'trips': trips,
+               'report': column_report(city, trips), 'histograms': {},
+               'loaded': time.time()}
+    # the histograms the charts are drawn from
+    for query in [{'bins': '10'}, {}, {'user_type': 'Subscriber'},
+                  {'user_type': 'Customer'}]:
+        city_histogram(dataset, query)
+    return dataset
+
+
+def refresh_cities(service):
+    """
+    Reloads every city of a service whose summary file has changed since it
+    was loaded, and returns the cities reloaded. A city whose file cannot be
+    read keeps being served from the data it had, with the error kept in
+    service['errors'] until it loads again.
+    """
+    reloaded = []
+    for city, filename in service['files'].items():
+        dataset = service['cities'].get(city)
+        try:
+            if dataset is None or file_stamp(filename) != dataset['stamp']:
+                # the new dataset replaces the old one in a single assignment
+                service['cities'][city] = load_city(city, filename)
+                service['errors'].pop(city, None)
+                reloaded.append(city)
+        except (OSError, ValueError) as error:
+            service['errors'][city] = str(error)
+    return reloaded
+
+
+def watch_cities(service):
+    while not service['stop'].wait(service['reload_interval']):
+        refresh_cities(service)
+
+
+def city_histogram(dataset, query):
+    """
+    Returns the histogram of the trip durations of a dataset that
+    duration_histogram would give for the bins and user_type of a query.
+    Histograms are kept with the dataset once computed.
+    """
+    trips = dataset['trips']
+    duration = trips['duration']
+    user_type = query.get('user_type')
+    bins = query.get('bins')
+    key = (bins, user_type)
+    if key in dataset['histograms']:
+        return dataset['histograms'][key]
+    if bins is None:
+        edges = [float(edge) for edge in question_5_bins]
+    elif ',' in bins:
+        edges = sorted(float(edge) for edge in bins.split(','))
+    else:
+        if int(bins) < 1:
+            raise ValueError('bins must be a positive number')
+        edges = (equal_bin_edges(int(bins), float(duration.min()), float(duration.max()))
+                 if len(duration) else equal_bin_edges(int(bins), 0.0, 0.0))
+    if user_type is not None:
+        names = trips['user_type_names']
+        code = names.index(user_type) if user_type in names else -1
+        duration = duration[trips['user_type'] == code]
+    counts, _ = np.histogram(duration, edges)
+    histogram = {'counts': counts.tolist(), 'edges': edges}
+    if len(dataset['histograms']) < kept_histograms:
+        dataset['histograms'][key] = histogram
+    return histogram
+
+
+def answer_query(service, path):
+    """
+    Returns the HTTP status and the JSON-friendly answer of a service to a
+    GET request for path.
+    """
+    url = urllib.parse.urlsplit(path)
+    parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+    query = dict(urllib.parse.parse_qsl(url.query))
+    if not parts or parts[0] != 'cities' or len(parts) > 3:
+        return 404, {'error': 'unknown path: {}'.format(url.path)}
+    if len(parts) == 1:
+        return 200, {city: {'file': dataset['filename'],
+                            'trips': len(dataset['trips']['duration']),
+                            'loaded': dataset['loaded'],
+                            'reload_error': service['errors'].get(city)}
+                     for city, dataset in service['cities'].items()}
+
+    dataset = service['cities'].get(parts[1])
+    if dataset is None:
+        return 404, {'error': 'unknown city: {}'.format(parts[1])}
+    report = dataset['report']
+    if len(parts) == 2:
+        return 200, report
+    name = parts[2]
+    if name == 'trips':
+        return 200, report['trips']
+    if name == 'trip-length':
+        return 200, {'average_duration': report['average_duration'],
+                     'percent_longer_than_30': report['percent_longer_than_30']}
+    if name == 'user-types':
+        trips = report['trips']
+        return 200, {user_type: {'trips': trips[user_type],
+                                 'average_duration': average_duration}
+                     for user_type, average_duration in
+                     report['average_duration_by_user_type'].items()}
+    if name == 'monthly':
+        return 200, report['monthly_trips']
+    if name == 'histogram':
+        try:
+            return 200, city_histogram(dataset, query)
+        except ValueError as error:
+            return 400, {'error': str(error)}
+    return 404, {'error': 'unknown statistic: {}'.format(name)}
+
+
+class TripQueryHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+    # seconds an idle connection keeps a worker thread
+    timeout = 5
+    # the headers and the body are sent by separate writes, which Nagle's
+    # algorithm would hold back until the client acknowledges the first
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, answer = answer_query(self.server.service, self.path)
+        body = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixTripQueryHandler(TripQueryHandler):
+    # Unix sockets have no Nagle's algorithm to turn off
+    disable_nagle_algorithm = False
+
+
+class PooledServerMixIn:
+    """
+    Handles the connections of a socketserver server on a pool of threads.
+    """
+    workers = None
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, 'executor'):
+            self.executor = ThreadPoolExecutor(self.workers)
+        self.executor.submit(self.process_pooled_request, request, client_address)
+
+    def process_pooled_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if hasattr(self, 'executor'):
+            self.executor.shutdown(wait=True)
+
+
+class TripQueryServer(PooledServerMixIn, HTTPServer):
+    pass
+
+
+# Windows has no Unix sockets
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixTripQueryServer(PooledServerMixIn, socketserver.UnixStreamServer):
+        pass
+
+
+def start_service(city_files, address=('127.0.0.1', 0), workers=8,
+                  reload_interval=1.0):
+    """
+    Loads the summary files {city: filename} and starts serving their
+    statistics at address, a (host, port) pair or the path of a Unix
+    socket, on a pool of workers threads. Port 0 picks a free port. Returns
+    the service, whose 'address' is where it listens, once it accepts
+    requests; stop it with stop_service.
+    """
+    service = {'files': dict(city_files), 'cities': {}, 'errors': {},
+               'reload_interval': reload_interval, 'stop': threading.Event()}
+    for city, filename in service['files'].items():
+        service['cities'][city] = load_city(city, filename)
+
+    if isinstance(address, tuple):
+        server = TripQueryServer(address, TripQueryHandler, bind_and_activate=False)
+    else:
+        # a socket left behind by a service that did not stop cleanly
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server = UnixTripQueryServer(address, UnixTripQueryHandler,
+                                     bind_and_activate=False)
+    server.workers = workers
+    server.service = service
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()
+        raise
+    service['server'] = server
+    service['address'] = server.server_address
+    service['threads'] = [threading.Thread(target=server.serve_forever, daemon=True),
+                          threading.Thread(target=watch_cities, args=(service,),
+                                           daemon=True)]
+    for thread in service['threads']:
+        thread.start()
+    return service
+
+
+def stop_service(service):
+    """
+    Stops a service started by start_service and closes its socket.
+    """
+    service['stop'].set()
+    service['server'].shutdown()
+    service['server'].server_close()
+    for thread in service['threads']:
+        thread.join()
+    if isinstance(service['address'], str) and os.path.exists(service['address']):
+        os.remove(service['address'])
+
+
+def service_connection(address, timeout=10):
+    """
+    Returns an HTTP connection to a service at address, a (host, port) pair
+    or the path of a Unix socket, to be passed to query_service. A
+    connection to a Unix socket cannot reconnect once the service closes it.
+    """
+    if isinstance(address, tuple):
+        return http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+    connection = http.client.HTTPConnection('localhost', timeout=timeout)
+    connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.sock.settimeout(timeout)
+    connection.sock.connect(address)
+    return connection
+
+
+def query_service(connection, path):
+    """
+    Sends a GET request for path on a connection of service_connection and
+    returns the HTTP status and the decoded JSON answer.
+    """
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
@@ -0,0 +1,231 @@
+"""
+Station-level analysis of the raw data files: the origin-destination
+matrix of the trips and the timeline of bikes in use.
+"""
+
+import csv
+import itertools
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .adapters import adapter_columns, city_adapters, start_time_parser
+from .files import open_data_file
+from .instrumentation import count_rows
+
+
+def merge_routes(routes, keys, counts, durations):
+    """
+    Adds the trip counts and total durations of the route keys of a block to
+    routes, a dictionary of sorted 'key', 'count' and 'duration' arrays.
+    """
+    keys = np.concatenate([routes['key'], keys])
+    unique, inverse = np.unique(keys, return_inverse=True)
+    routes['key'] = unique
+    routes['count'] = np.bincount(inverse, np.concatenate([routes['count'], counts]),
+                                  len(unique)).astype(np.int64)
+    routes['duration'] = np.bincount(inverse, np.concatenate([routes['duration'],
+                                                               durations]),
+                                     len(unique))
+
+
+def od_matrix(filename, city, block_rows=65536):
+    """
+    Returns the origin-destination matrix of a raw city file: 'stations',
+    the station identifiers of the file in the order of their codes,
+    'origin' and 'destination' codes, 'count' and 'duration' (total
+    minutes) of every route, sorted by origin then destination, and
+    'outflow' and 'inflow', the trips leaving and arriving at each station
+    by hour of the day (stations x 24). Trips without both stations are
+    left out.
+    """
+    adapter = city_adapters[city]
+    if adapter['start_station_column'] is None:
+        raise ValueError('the files of {} have no station columns'.format(city))
+    parse_times = start_time_parser(adapter)
+    station_codes = {}
+    routes = {'key': np.zeros(0, dtype=np.int64),
+              'count': np.zeros(0, dtype=np.int64), 'duration': np.zeros(0)}
+    outflow = np.zeros((0, 24), dtype=np.int64)
+    inflow = np.zeros((0, 24), dtype=np.int64)
+
+    with open_data_file(filename) as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader)
+        i_duration, i_start, i_user = adapter_columns(adapter, header)
+        i_end, i_origin, i_destination = [header.index(adapter[column]) for column in
+                                          ['end_column', 'start_station_column',
+                                           'end_station_column']]
+        while True:
+            block = list(itertools.islice(reader, block_rows))
+            if not block:
+                break
+            rows = [row for row in block if row and row[i_origin] and row[i_destination]]
+            if not rows:
+                continue
+            count_rows(len(rows))
+            origin = np.array([station_codes.setdefault(row[i_origin], len(station_codes))
+                               for row in rows], dtype=np.int64)
+            destination = np.array([station_codes.setdefault(row[i_destination],
+                                                             len(station_codes))
+                                    for row in rows], dtype=np.int64)
+            durations = np.fromiter((float(row[i_duration]) for row in rows),
+                                    np.float64, len(rows)) / adapter['divisor']
+            merge_routes(routes, origin << 32 | destination,
+                         np.ones(len(rows), dtype=np.int64), durations)
+
+            n_stations = len(station_codes)
+            start_hours = np.array(parse_times([row[i_start] for row in rows])[1])
+            end_hours = np.array(parse_times([row[i_end] for row in rows])[1])
+            outflow = np.pad(outflow, ((0, n_stations - len(outflow)), (0, 0)))
+            inflow = np.pad(inflow, ((0, n_stations - len(inflow)), (0, 0)))
+            np.add.at(outflow, (origin, start_hours), 1)
+            np.add.at(inflow, (destination, end_hours), 1)
+
+    return {'stations': list(station_codes),
+            'origin': (routes['key'] >> 32).astype(np.int32),
+            'destination': (routes['key'] & 0xffffffff).astype(np.int32),
+            'count': routes['count'], 'duration': routes['duration'],
+            'outflow': outflow, 'inflow': inflow}
+
+
+def od_csr(matrix):
+    """
+    Returns the routes of an origin-destination matrix in compressed sparse
+    row form: the routes from station code i are those between indptr[i]
+    and indptr[i + 1] of the 'destination', 'count' and 'duration' arrays.
+    """
+    n_stations = len(matrix['stations'])
+    indptr = np.zeros(n_stations + 1, dtype=np.int64)
+    np.cumsum(np.bincount(matrix['origin'], minlength=n_stations), out=indptr[1:])
+    return {'indptr': indptr, 'destination': matrix['destination'],
+            'count': matrix['count'], 'duration': matrix['duration']}
+
+
+def route_trips(matrix, csr, origin, destination):
+    """
+    Returns the number of trips and mean duration of the route between two
+    station identifiers, using the compressed rows csr of matrix.
+    """
+    codes = {station: code for code, station in enumerate(matrix['stations'])}
+    if origin not in codes or destination not in codes:
+        return (0, None)
+    start, end = csr['indptr'][codes[origin]], csr['indptr'][codes[origin] + 1]
+    # the destinations of a row are sorted
+    i = start + np.searchsorted(csr['destination'][start:end], codes[destination])
+    if i == end or csr['destination'][i] != codes[destination]:
+        return (0, None)
+    return (int(csr['count'][i]), float(csr['duration'][i] / csr['count'][i]))
+
+
+def top_routes(matrix, k=10):
+    """
+    Returns the k routes with the most trips, busiest first, as (start
+    station, end station, trips, mean duration) tuples.
+    """
+    order = np.argsort(-matrix['count'], kind='stable')[:k]
+    stations = matrix['stations']
+    return [(stations[matrix['origin'][i]], stations[matrix['destination'][i]],
+             int(matrix['count'][i]), float(matrix['duration'][i] / matrix['count'][i]))
+            for i in order]
+
+
+def station_imbalance(matrix, hour=None):
+    """
+    Returns {station: trips arriving - trips leaving} for every station,
+    over the whole day or in one hour of the day. Stations with a negative
+    balance lose bikes.
+    """
+    if hour is None:
+        balance = matrix['inflow'].sum(axis=1) - matrix['outflow'].sum(axis=1)
+    else:
+        balance = matrix['inflow'][:, hour] - matrix['outflow'][:, hour]
+    return dict(zip(matrix['stations'], balance.tolist()))
+
+
+# date string -> ordinal day, and clock string -> minute of the day, of the
+# times converted so far
+timeline_days = {}
+
+
+timeline_clocks = {}
+
+
+def minutes_since(values, date_format, first_day):
+    """
+    Returns the minutes between the start of the ordinal day first_day and
+    each time string of a list, 'date clock' in date_format and a clock
+    starting with hours and minutes.
+    """
+    minutes = []
+    for value in values:
+        date, clock = value.split(' ')
+        day = timeline_days.get(date)
+        if day is None:
+            day = timeline_days[date] = datetime.strptime(date, date_format).toordinal()
+        minute = timeline_clocks.get(clock)
+        if minute is None:
+            hour, minute = clock.split(':')[:2]
+            minute = timeline_clocks[clock] = int(hour) * 60 + int(minute)
+        minutes.append((day - first_day) * 1440 + minute)
+    return np.array(minutes, dtype=np.int64)
+
+
+def bikes_in_use(filename, city, bucket_minutes=1, year=None, block_rows=65536):
+    """
+    Returns the timeline of the trips under way in a raw city file, per
+    bucket of bucket_minutes over a year (by default the year of the first
+    trip) and the first day of the next, as a dictionary with the 'start'
+    datetime of the first bucket, 'bucket_minutes' and 'in_use', the number
+    of trips under way at some point of each bucket. Trips partly outside
+    the timeline are clipped to it and trips wholly outside it are left out.
+    """
+    adapter = city_adapters[city]
+    if adapter['end_column'] is None:
+        raise ValueError('the files of {} have no end times'.format(city))
+    diff = None
+    with open_data_file(filename) as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader)
+        i_start = header.index(adapter['start_column'])
+        i_end = header.index(adapter['end_column'])
+        while True:
+            rows = [row for row in itertools.islice(reader, block_rows) if row]
+            if not rows:
+                break
+            count_rows(len(rows))
+            if diff is None:
+                if year is None:
+                    year = datetime.strptime(rows[0][i_start].split(' ')[0],
+                                             adapter['date_format']).year
+                first_day = datetime(year, 1, 1).toordinal()
+                n_days = datetime(year + 1, 1, 1).toordinal() - first_day + 1
+                n_buckets = -(-n_days * 1440 // bucket_minutes)
+                diff = np.zeros(n_buckets + 1, dtype=np.int64)
+            starts = minutes_since([row[i_start] for row in rows],
+                                   adapter['date_format'], first_day) // bucket_minutes
+            ends = minutes_since([row[i_end] for row in rows],
+                                 adapter['date_format'], first_day) // bucket_minutes
+            ends = np.maximum(ends, starts)
+            # trips wholly outside the timeline are dropped, the others clipped
+            inside = (ends >= 0) & (starts < n_buckets)
+            starts = np.clip(starts[inside], 0, n_buckets - 1)
+            ends = np.clip(ends[inside], 0, n_buckets - 1)
+            diff += np.bincount(starts, minlength=n_buckets + 1)
+            diff -= np.bincount(ends + 1, minlength=n_buckets + 1)
+
+    if diff is None:
+        return {'start': None, 'bucket_minutes': bucket_minutes,
+                'in_use': np.zeros(0, dtype=np.int64)}
+    return {'start': datetime(year, 1, 1), 'bucket_minutes': bucket_minutes,
+            'in_use': np.cumsum(diff[:-1])}
+
+
+def peak_buckets(timeline, k=5):
+    """
+    Returns the k buckets of a timeline with the most trips under way, as
+    (start datetime, trips) pairs, busiest first.
+    """
+    order = np.argsort(-timeline['in_use'], kind='stable')[:k]
+    return [(timeline['start'] + timedelta(minutes=int(i) * timeline['bucket_minutes']),
+             int(timeline['in_use'][i])) for i in order]
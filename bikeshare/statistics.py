@@ -0,0 +1,568 @@
+"""
+The statistics of the summary files, computed in a single scan of a file
+without numpy, and the functions answering the questions of the analysis.
+"""
+
+import bisect
+import csv
+import json
+import math
+import os
+
+from .adapters import summary_user_type, summary_user_types
+from .cache import cached_result
+from .files import open_data_file
+from .instrumentation import count_rows, instrumented
+from .moments import merge_moments, moments_summary, new_moments
+from .sketches import (compress_sketch, merge_sketches, new_sketch,
+                       sketch_quantile)
+
+
+# Trip durations are summarized as histograms that are filled in as the file
+# is read, so their size depends on the number of bins, not of trips.
+
+# the five-minute bins of the histograms of Question 5
+question_5_bins = range(0, 75, 5)
+
+
+def new_histogram(edges):
+    """
+    Returns an empty histogram over a list of bin edges. As with plt.hist,
+    each bin holds the values from its left edge up to its right edge, except
+    the last one, which also holds its right edge.
+    """
+    edges = [float(edge) for edge in edges]
+    return {'edges': edges, 'counts': [0] * (len(edges) - 1)}
+
+
+def add_to_histogram(histogram, value):
+    # values outside of the edges are left out, as plt.hist does
+    edges = histogram['edges']
+    if edges[0] <= value <= edges[-1]:
+        i = bisect.bisect_right(edges, value) - 1
+        histogram['counts'][min(i, len(edges) - 2)] += 1
+
+
+def equal_bin_edges(bins, low, high):
+    """
+    Returns the edges of bins equal bins from low to high, as plt.hist
+    computes them, widened by half a unit on each side when low == high.
+    """
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    step = (high - low) / bins
+    return [low + i * step for i in range(bins)] + [high]
+
+
+def merge_histograms(histogram, other):
+    """
+    Adds the counts of another histogram over the same bins to histogram.
+    """
+    if histogram['edges'] != other['edges']:
+        raise ValueError('cannot merge histograms with different bins')
+    histogram['counts'] = [a + b for a, b in zip(histogram['counts'], other['counts'])]
+    return histogram
+
+
+def read_durations(filename):
+    """
+    Yields the duration and user type of every trip of a condensed data file,
+    one at a time, skipping the malformed rows scan_summary counts.
+    """
+    with open_data_file(filename) as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader)
+        i_duration = header.index('duration')
+        i_user = header.index('user_type')
+        try:
+            for row in reader:
+                try:
+                    trip = float(row[i_duration]), (summary_user_types.get(row[i_user]) or
+                                                    summary_user_type(row[i_user]))
+                except (ValueError, IndexError):
+                    continue
+                yield trip
+        finally:
+            count_rows(reader.line_num - 1)
+
+
+# name -> (init, update, finish) for every statistic computed by scan_summary
+summary_statistics = {}
+
+
+def register_statistic(name, init, update, finish=None, merge=None):
+    """
+    Registers a statistic to be computed by scan_summary. init() returns a
+    fresh state, update(state, duration, month, hour, day_of_week, user_type)
+    folds a single trip into the state and finish(state), if given, turns the
+    final state into the reported value. merge(state, other), if given, folds
+    the state of another part of the data into state, so the statistic can be
+    computed in parts.
+    """
+    summary_statistics[name] = (init, update, finish, merge)
+
+
+def count_user_types(state, duration, month, hour, day_of_week, user_type):
+    totals = state.get(user_type)
+    if totals is None:
+        totals = state[user_type] = [0, 0.0]
+    totals[0] += 1
+    totals[1] += duration
+
+
+def count_trip_length(state, duration, month, hour, day_of_week, user_type):
+    state[0] += 1
+    state[1] += duration
+    if duration > 30:
+        state[2] += 1
+
+
+def count_months(state, duration, month, hour, day_of_week, user_type):
+    months = state.get(user_type)
+    if months is None:
+        months = state[user_type] = {str(i): 0 for i in range(1, 13)}
+    months[month] += 1
+
+
+def count_duration_range(state, duration, month, hour, day_of_week, user_type):
+    if duration < state[0]:
+        state[0] = duration
+    if duration > state[1]:
+        state[1] = duration
+
+
+def count_duration_moments(state, duration, month, hour, day_of_week, user_type):
+    moments = state.get(user_type)
+    if moments is None:
+        moments = state[user_type] = new_moments()
+    # add_to_moments, inlined as this runs for every trip
+    n = moments['n'] = moments['n'] + 1
+    mean = moments['mean']
+    delta = duration - mean
+    mean = moments['mean'] = mean + delta / n
+    moments['m2'] += delta * (duration - mean)
+    total = moments['sum']
+    new_total = moments['sum'] = total + duration
+    if abs(total) >= abs(duration):
+        moments['compensation'] += (total - new_total) + duration
+    else:
+        moments['compensation'] += (duration - new_total) + total
+    if duration < moments['min']:
+        moments['min'] = duration
+    if duration > moments['max']:
+        moments['max'] = duration
+
+
+def count_duration_histograms(state, duration, month, hour, day_of_week, user_type):
+    histogram = state.get(user_type)
+    if histogram is None:
+        histogram = state[user_type] = new_histogram(question_5_bins)
+    add_to_histogram(histogram, duration)
+
+
+def count_duration_sketches(state, duration, month, hour, day_of_week, user_type):
+    sketches = state.get(user_type)
+    if sketches is None:
+        sketches = state[user_type] = {'month': {}, 'hour': {}}
+    month_sketch = sketches['month'].get(month)
+    if month_sketch is None:
+        month_sketch = sketches['month'][month] = new_sketch()
+    hour_sketch = sketches['hour'].get(hour)
+    if hour_sketch is None:
+        hour_sketch = sketches['hour'][hour] = new_sketch()
+    # add_to_sketch, inlined as this runs twice for every trip
+    for sketch in (month_sketch, hour_sketch):
+        sketch['levels'][0].append(duration)
+        sketch['n'] += 1
+        sketch['size'] += 1
+        if sketch['size'] >= sketch['capacity']:
+            compress_sketch(sketch)
+
+
+def merge_user_types(state, other):
+    for user_type, (trips, length) in other.items():
+        totals = state.setdefault(user_type, [0, 0.0])
+        totals[0] += trips
+        totals[1] += length
+
+
+def merge_trip_length(state, other):
+    for i in range(3):
+        state[i] += other[i]
+
+
+def merge_months(state, other):
+    for user_type, months in other.items():
+        totals = state.setdefault(user_type, {str(i): 0 for i in range(1, 13)})
+        for month, trips in months.items():
+            totals[month] += trips
+
+
+def merge_duration_range(state, other):
+    state[0] = min(state[0], other[0])
+    state[1] = max(state[1], other[1])
+
+
+def merge_duration_moments(state, other):
+    for user_type, moments in other.items():
+        merge_moments(state.setdefault(user_type, new_moments()), moments)
+
+
+def merge_duration_histograms(state, other):
+    for user_type, histogram in other.items():
+        if user_type in state:
+            merge_histograms(state[user_type], histogram)
+        else:
+            state[user_type] = new_histogram(histogram['edges'])
+            merge_histograms(state[user_type], histogram)
+
+
+def merge_duration_sketches(state, other):
+    for user_type, sketches in other.items():
+        totals = state.setdefault(user_type, {'month': {}, 'hour': {}})
+        for dimension in ['month', 'hour']:
+            for key, sketch in sketches[dimension].items():
+                if key in totals[dimension]:
+                    merge_sketches(totals[dimension][key], sketch)
+                else:
+                    totals[dimension][key] = merge_sketches(new_sketch(sketch['k']),
+                                                            sketch)
+
+
+# {user_type: [trips, total duration]}
+register_statistic('user_types', dict, count_user_types, merge=merge_user_types)
+
+
+# (trips, total duration, trips longer than 30 minutes)
+register_statistic('trip_length', lambda: [0, 0, 0], count_trip_length, tuple,
+                   merge_trip_length)
+
+
+# {user_type: {month: trips}}
+register_statistic('months', dict, count_months, merge=merge_months)
+
+
+# (shortest duration, longest duration)
+register_statistic('duration_range', lambda: [math.inf, -math.inf],
+                   count_duration_range, tuple, merge_duration_range)
+
+
+# {user_type: moments of the durations}
+register_statistic('duration_moments', dict, count_duration_moments,
+                   merge=merge_duration_moments)
+
+
+# {user_type: histogram of the durations over the bins of Question 5}
+register_statistic('duration_histograms', dict, count_duration_histograms,
+                   merge=merge_duration_histograms)
+
+
+# {user_type: {'month': {month: sketch}, 'hour': {hour: sketch}}} of the
+# durations; the sketches of all months together cover every trip
+register_statistic('duration_sketches', dict, count_duration_sketches,
+                   merge=merge_duration_sketches)
+
+
+def scan_summary(filename):
+    """
+    Reads a condensed trip data file once and returns a dictionary with the
+    value of every registered statistic, and the number of rows left out
+    because they do not parse, such as a last row cut short, as
+    'malformed_rows'.
+    """
+    names = list(summary_statistics)
+    states = [summary_statistics[name][0]() for name in names]
+    updates = [(summary_statistics[name][1], state)
+               for name, state in zip(names, states)]
+
+    with open_data_file(filename) as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader)
+        i_duration, i_month, i_hour, i_day, i_user = [
+            header.index(column) for column in
+            ['duration', 'month', 'hour', 'day_of_week', 'user_type']]
+
+        malformed_rows = 0
+        for row in reader:
+            try:
+                duration = float(row[i_duration])
+                month = row[i_month]
+                hour = row[i_hour]
+                day_of_week = row[i_day]
+                # summary_user_type only runs for a value it rejects
+                user_type = (summary_user_types.get(row[i_user]) or
+                             summary_user_type(row[i_user]))
+            except (ValueError, IndexError):
+                malformed_rows += 1
+                continue
+            for update, state in updates:
+                update(state, duration, month, hour, day_of_week, user_type)
+        count_rows(reader.line_num - 1)
+
+    results = {}
+    for name, state in zip(names, states):
+        finish = summary_statistics[name][2]
+        results[name] = finish(state) if finish else state
+    results['malformed_rows'] = malformed_rows
+    return results
+
+
+# filename -> ((size, mtime), statistics) for the files scanned so far
+summary_scans = {}
+
+
+def summary_aggregates(filename):
+    """
+    Returns the statistics of scan_summary for a condensed data file, only
+    scanning the file again if it has changed since the last scan.
+    """
+    stat = os.stat(filename)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    cached = summary_scans.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = summary_scans[filename] = (stamp, scan_summary(filename))
+    return cached[1]
+
+
+def running_aggregates(filename):
+    """
+    Returns the statistics condense_data_incremental keeps up to date for a
+    condensed data file, or None if there are none or the file has changed
+    since they were saved.
+    """
+    try:
+        with open(filename + '.state.json') as f_in:
+            state = json.load(f_in)
+    except FileNotFoundError:
+        return None
+    stat = os.stat(filename)
+    if state['summary'] != [stat.st_size, stat.st_mtime_ns]:
+        return None
+
+    results = {}
+    for name, value in state['aggregates'].items():
+        finish = summary_statistics[name][2]
+        results[name] = finish(value) if finish else value
+    # condense_data_incremental only writes rows that parse
+    results['malformed_rows'] = 0
+    return results
+
+
+def summary_statistic(filename, name):
+    """
+    Returns one statistic of a condensed data file, read from its running
+    aggregates when they are up to date and from a scan of the file otherwise.
+    """
+    running = running_aggregates(filename)
+    if running is not None and name in running:
+        return running[name]
+    return summary_aggregates(filename)[name]
+
+
+@instrumented()
+@cached_result
+def number_of_trips(filename):
+    """
+    This function reads in a file with trip data and reports the number of
+    trips made by subscribers, customers, and total overall.
+    """
+    # tally up ride types from the single scan of the file
+    user_types = summary_statistic(filename, 'user_types')
+    n_subscribers = user_types.get('Subscriber', [0])[0]
+    n_customers = sum(totals[0] for user_type, totals in user_types.items()
+                      if user_type != 'Subscriber')
+
+    # compute total number of rides
+    n_total = n_subscribers + n_customers
+
+    # return tallies as a tuple
+    return(n_subscribers, n_customers, n_total)
+
+
+def rounded_mean(moments):
+    # the mean duration to a tenth of a minute, or None without any trip
+    mean = moments_summary(moments)['mean']
+    return None if mean is None else round(mean, 1)
+
+
+@instrumented()
+@cached_result
+def length_of_trip(filename):
+    trip_moments = new_moments()
+    for moments in summary_statistic(filename, 'duration_moments').values():
+        merge_moments(trip_moments, moments)
+    total_of_trips = trip_moments['n']
+    trip_above_30 = summary_statistic(filename, 'trip_length')[2]
+
+    avg_length = rounded_mean(trip_moments)
+    trips_longer_30 = (round(float(trip_above_30 / total_of_trips)*100, 1)
+                       if total_of_trips else None)
+
+    return (avg_length, trips_longer_30)
+
+
+@instrumented()
+@cached_result
+def duration_ridership(filename):
+
+    sub_moments = new_moments()
+    cus_moments = new_moments()
+    for user_type, moments in summary_statistic(filename, 'duration_moments').items():
+        if user_type == 'Customer':
+            merge_moments(cus_moments, moments)
+        else:
+            merge_moments(sub_moments, moments)
+    subscibers = sub_moments['n']
+    customers = cus_moments['n']
+
+    # None for a user type without any trip
+    sub_avg = rounded_mean(sub_moments)
+    cus_avg = rounded_mean(cus_moments)
+    total_users = subscibers + customers
+    return (subscibers, customers, sub_avg, cus_avg, total_users)
+
+
+@instrumented()
+@cached_result
+def duration_statistics(filename, user_type=None):
+    """
+    Returns the number, mean, variance, standard deviation, shortest and
+    longest of the trip durations of a condensed data file, of one user type
+    or of all trips, as a dictionary.
+    """
+    durations = new_moments()
+    for name, moments in summary_statistic(filename, 'duration_moments').items():
+        if user_type is None or name == user_type:
+            merge_moments(durations, moments)
+    return moments_summary(durations)
+
+
+# not cached, as the result is a list as long as the file
+@instrumented()
+def visualize_trip_time(filename):
+    data=[duration for duration, user_type in read_durations(filename)]
+    return data
+
+
+@instrumented()
+@cached_result
+def duration_histogram(filename, bins=question_5_bins, user_type=None):
+    """
+    Returns the counts and bin edges of the histogram of the trip durations
+    of a condensed data file, of one user type or of all trips. bins is
+    either a list of bin edges or, as for plt.hist, a number of equal bins
+    between the shortest and the longest duration. The durations are binned
+    as the file is read, never collected into a list.
+    """
+    if isinstance(bins, int):
+        duration_range = summary_aggregates(filename)['duration_range']
+        if duration_range[0] > duration_range[1]:
+            # no trips, so no range to divide
+            duration_range = (0.0, 0.0)
+        edges = equal_bin_edges(bins, *duration_range)
+    else:
+        edges = bins
+    histogram = new_histogram(edges)
+
+    if histogram['edges'] == new_histogram(question_5_bins)['edges']:
+        # already counted by the single scan of the file
+        for name, counts in summary_aggregates(filename)['duration_histograms'].items():
+            if user_type is None or name == user_type:
+                merge_histograms(histogram, counts)
+    else:
+        for duration, name in read_durations(filename):
+            if user_type is None or name == user_type:
+                add_to_histogram(histogram, duration)
+    return (histogram['counts'], histogram['edges'])
+
+
+@instrumented()
+def user_type_durations(filename, user_type, cutoff=75):
+    """
+    Returns the durations, in file order, of the trips of one user type that
+    are shorter than cutoff minutes. Not cached, as the list grows with the
+    file.
+    """
+    return [duration for duration, name in read_durations(filename)
+            if name == user_type and duration < cutoff]
+
+
+@instrumented()
+@cached_result
+def monthly_trips(filename):
+    """
+    Returns the lists of the number of Subscriber and Customer trips in each
+    month, from January to December.
+    """
+    month_trip_sub={}
+    month_trip_cus={}
+
+    for i in range(1,13):
+        month_trip_sub[str(i)]=0
+        month_trip_cus[str(i)]=0
+    for user_type, months in summary_statistic(filename, 'months').items():
+        month_trip = month_trip_cus if user_type=='Customer' else month_trip_sub
+        for month, trips in months.items():
+            month_trip[month]+=trips
+    return (list(month_trip_sub.values()), list(month_trip_cus.values()))
+
+
+def summary_sketches(filename):
+    """
+    Returns the duration sketches of a condensed data file, loaded from
+    filename + '.sketches.json' if they were saved since the file last
+    changed, and computed and saved otherwise. Sketches that cannot be
+    saved, as next to a file in a read-only directory, are still returned.
+    """
+    sketch_file = filename + '.sketches.json'
+    stat = os.stat(filename)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    try:
+        with open(sketch_file) as f_in:
+            saved = json.load(f_in)
+        if saved['summary'] == stamp:
+            return saved['sketches']
+    except FileNotFoundError:
+        pass
+
+    sketches = summary_statistic(filename, 'duration_sketches')
+    try:
+        with open(sketch_file + '.tmp', 'w') as f_out:
+            json.dump({'summary': stamp, 'sketches': sketches}, f_out)
+        os.replace(sketch_file + '.tmp', sketch_file)
+    except OSError:
+        try:
+            os.remove(sketch_file + '.tmp')
+        except OSError:
+            pass
+    return sketches
+
+
+@instrumented()
+@cached_result
+def duration_percentiles(filename, percentiles=(50, 90, 99), user_type=None,
+                         month=None, hour=None):
+    """
+    Returns a dictionary from each of percentiles to the estimated trip
+    duration at that percentile, for one user type or all trips and
+    optionally for one month (1-12) or one hour of the day (0-23). The
+    sketches are kept per month and per hour, not per hour of each month,
+    so month and hour cannot both be given.
+    """
+    if month is not None and hour is not None:
+        raise ValueError('percentiles are kept per month or per hour, not both; '
+                         'filtered_trips gives the trips of an hour in a month')
+    sketch = new_sketch()
+    for name, sketches in summary_sketches(filename).items():
+        if user_type is not None and name != user_type:
+            continue
+        if month is not None:
+            parts = [sketches['month'].get(str(month))]
+        elif hour is not None:
+            parts = [sketches['hour'].get(str(hour))]
+        else:
+            parts = sketches['month'].values()
+        for part in parts:
+            if part is not None:
+                merge_sketches(sketch, part)
+    return {p: sketch_quantile(sketch, p / 100) for p in percentiles}